@@ -1,61 +1,430 @@
 import os
-from flask import Flask, request, jsonify, abort
-from models import setup_db, Movie, Actor, MovieRoles
+from functools import wraps
+from flask import Flask, Response, request, jsonify, abort, make_response, current_app, stream_with_context, g
+from models import setup_db, unit_of_work, db, TableVersion, Movie, Actor, MovieRoles, pool_stats, is_timeout_error
 from flask_cors import CORS
-from auth.auth import AuthError, requires_auth
+from sqlalchemy.orm import selectinload, load_only
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from werkzeug.exceptions import HTTPException
+from auth.auth import AuthError, requires_auth, jwks_cache, token_cache
+from search import search_items
+from counts import table_total, query_total, COUNT_MODES
+from read_models import read_rows, read_rows_by_id, json_response, parse_fields
+from cache import init_response_cache, cached_response, table_versions
+from metrics import init_metrics, render_metrics
+from query_tracker import init_query_tracking, query_budget
+from export import export_lines, gzip_lines
+from bulk import import_movies, import_actors, update_many, BULK_IMPORT_CHUNK_SIZE, MAX_BULK_IMPORT_CHUNK_SIZE, MAX_BATCH_UPDATE_SIZE
 import sys
 import json
+import base64
 
 ITEMS_PER_PAGE = 10
-
-def paginate_items(request, selection):
+MAX_ITEMS_PER_PAGE = 100
+
+# per-route statement timeouts in milliseconds, overriding DB_STATEMENT_TIMEOUT
+SEARCH_TIME_BUDGET = int(os.environ.get('SEARCH_TIME_BUDGET', 2000))
+BULK_IMPORT_TIME_BUDGET = int(os.environ.get('BULK_IMPORT_TIME_BUDGET', 30000))
+
+# the most ids one multi-get may ask for
+MAX_BATCH_GET_SIZE = int(os.environ.get('MAX_BATCH_GET_SIZE', 100))
+
+'''
+get_page_size(request)
+    returns the per_page requested by the client, capped at MAX_ITEMS_PER_PAGE
+'''
+def get_page_size(request):
+  per_page = request.args.get('per_page', ITEMS_PER_PAGE, type=int)
+  return max(1, min(per_page, MAX_ITEMS_PER_PAGE))
+
+'''
+paginate_items(request, selection, fields)
+    applies LIMIT/OFFSET for the requested page to the selection query
+    and reads only the rows on that page
+'''
+def paginate_items(request, selection, fields=None):
   page = request.args.get('page', 1, type=int)
-  start =  (page - 1) * ITEMS_PER_PAGE
-  end = start + ITEMS_PER_PAGE
-
-  items = [item.format() for item in selection]
-  current_items = items[start:end]
-
-  return current_items
+  if page < 1:
+    return []
+
+  per_page = get_page_size(request)
+  start = (page - 1) * per_page
+
+  return read_rows(selection.offset(start).limit(per_page), fields)
+
+'''
+encode_cursor(key, value) / decode_cursor(key, cursor)
+    an opaque cursor is the urlsafe base64 of the sort key and the last value seen.
+    the keys are integer ids, so a cursor holding anything else is a 400
+'''
+def encode_cursor(key, value):
+  data = json.dumps({'key': key, 'value': value}).encode()
+  return base64.urlsafe_b64encode(data).decode()
+
+def decode_cursor(key, cursor):
+  try:
+    data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+  except (ValueError, TypeError):
+    abort(400)
+
+  if not isinstance(data, dict) or data.get('key') != key or type(data.get('value')) is not int:
+    abort(400)
+  return data['value']
+
+'''
+paginate_items_by_cursor(request, selection, key, fields)
+    keyset pagination: seeks past the cursor with WHERE key > :cursor so every
+    page costs the same as the first one. returns the formatted page and the
+    cursor of the next page, or None on the last page
+'''
+def paginate_items_by_cursor(request, selection, key, fields=None):
+  per_page = get_page_size(request)
+  cursor = request.args.get('cursor', '')
+
+  if cursor:
+    selection = selection.filter(key > decode_cursor(key.key, cursor))
+
+  items = read_rows(selection.order_by(key).limit(per_page + 1), fields)
+
+  next_cursor = None
+  if len(items) > per_page:
+    items = items[:per_page]
+    next_cursor = encode_cursor(key.key, items[-1][key.key])
+
+  return items, next_cursor
+
+'''
+get_ids(value)
+    the ids of a multi-get, from a comma separated ?ids= value or a JSON list
+    of integers, in the caller's order without repeats. anything that is not
+    an integer id, or more than MAX_BATCH_GET_SIZE of them, is a 400
+'''
+def get_ids(value):
+  if isinstance(value, str):
+    try:
+      value = [int(id) for id in value.split(',')]
+    except ValueError:
+      abort(400)
+
+  if not isinstance(value, list) or any(type(id) is not int for id in value):
+    abort(400)
+
+  ids = list(dict.fromkeys(value))
+
+  if not ids or len(ids) > MAX_BATCH_GET_SIZE:
+    abort(400)
+  return ids
+
+'''
+batch_get_response(request, model, ids)
+    the rows with the given ids, in that order, read with one query. ids that
+    match no row are listed under missing
+'''
+def batch_get_response(request, model, ids):
+  fields = get_fields(request, model)
+  items, missing = read_rows_by_id(model, ids, fields)
+  return json_response({
+    'success': True,
+    model.__tablename__.lower() + 's': items,
+    'missing': missing
+  })
+
+'''
+get_chunk_size(request)
+    returns the chunk_size requested for a bulk import, capped at MAX_BULK_IMPORT_CHUNK_SIZE
+'''
+def get_chunk_size(request):
+  chunk_size = request.args.get('chunk_size', BULK_IMPORT_CHUNK_SIZE, type=int)
+  return max(1, min(chunk_size, MAX_BULK_IMPORT_CHUNK_SIZE))
+
+'''
+batch_update_response(request, model)
+    applies the list of {id, changes} items in the body in one transaction and
+    reports the result of each. with ?atomic=true any failed item fails the
+    whole batch with a 422 and nothing is written
+'''
+def batch_update_response(request, model):
+  items = request.get_json(silent=True)
+  if not isinstance(items, list) or not items or len(items) > MAX_BATCH_UPDATE_SIZE:
+    abort(400)
+
+  atomic = request.args.get('atomic', 'false').lower() in ('1', 'true', 'yes')
+  report = update_many(model, items, atomic)
+  if atomic and report.failed:
+    return jsonify(dict(report.format(), success=False)), 422
+  return jsonify(dict(report.format(), success=True))
+
+'''
+export_response(request, model)
+    streams the whole table as NDJSON, gzip-compressed when the client accepts it
+    and with each row's roles embedded with ?expand=roles. Vary tells caches the
+    body depends on Accept-Encoding either way
+'''
+def export_response(request, model):
+  fields = get_fields(request, model)
+  lines = export_lines(model, with_roles='roles' in get_expand(request), fields=fields)
+  headers = {'Vary': 'Accept-Encoding'}
+  if 'gzip' in request.accept_encodings:
+    lines = gzip_lines(lines)
+    headers['Content-Encoding'] = 'gzip'
+
+  return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers=headers)
+
+'''
+get_fields(request, model)
+    returns the format() columns chosen with ?fields=, all of them by default
+'''
+def get_fields(request, model):
+  try:
+    return parse_fields(model, request.args.get('fields'))
+  except ValueError:
+    abort(400)
+
+'''
+get_expand(request)
+    returns the set of related collections requested with ?expand=a,b
+'''
+def get_expand(request):
+  return set(filter(None, request.args.get('expand', '').split(',')))
+
+'''
+get_return_preference(request)
+    'minimal' or 'representation' when the client asks for one with a
+    Prefer: return=... header (RFC 7240), None otherwise
+'''
+def get_return_preference(request):
+  for preference in request.headers.get('Prefer', '').split(','):
+    name, _, value = preference.partition('=')
+    value = value.strip().strip('"')
+    if name.strip().lower() == 'return' and value in ('minimal', 'representation'):
+      return value
+  return None
+
+'''
+get_count_mode(request)
+    how the total of a list or search is counted, chosen with
+    ?count=exact|estimate|none, exact by default
+'''
+def get_count_mode(request):
+  mode = request.args.get('count', 'exact')
+  if mode not in COUNT_MODES:
+    abort(400)
+  return mode
+
+'''
+add_total(data, name, total)
+    adds a (total, estimated) pair from counts to the response data, unless
+    the count was skipped
+'''
+def add_total(data, name, total):
+  count, estimated = total
+  if count is not None:
+    data['total_' + name] = count
+    data['total_estimated'] = estimated
+  return data
+
+'''
+write_response(request, model, action, id, item)
+    the response to a create, update or delete of item, shaped by the Prefer header:
+    return=minimal gives the id and the table's new version, return=representation
+    gives the item. without a preference the response also carries the first page
+    of the table and its total, as it always has
+'''
+def write_response(request, model, action, id, item):
+  preference = get_return_preference(request)
+  name = model.__tablename__.lower()
+  data = {'success': True, action: id}
+
+  if preference == 'minimal':
+    data['version'] = TableVersion.get(model.__tablename__).version
+  elif preference == 'representation':
+    data[name] = item
+  else:
+    data[name + 's'] = paginate_items(request, model.query.order_by(model.id))
+    data['total_' + name + 's'] = table_total(model)[0]
+
+  response = jsonify(data)
+  if preference is not None:
+    response.headers['Preference-Applied'] = 'return=' + preference
+  return response
+
+'''
+time_budget(milliseconds)
+    gives every statement the route runs at most this long on the database
+    server. a statement that runs over is cancelled and the request answered
+    with a 503
+'''
+def time_budget(milliseconds):
+  def time_budget_decorator(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+      g.statement_timeout = milliseconds
+      return f(*args, **kwargs)
+    return wrapper
+  return time_budget_decorator
+
+'''
+conditional_get(validators)
+    answers a GET whose If-None-Match / If-Modified-Since still match with a 304
+    before the view loads or formats any rows, and sends ETag and Last-Modified
+    otherwise. validators(**view_args) returns (etag, last_modified) from a cheap
+    version lookup, or None when the resource does not exist
+'''
+def conditional_get(validators):
+  def conditional_get_decorator(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+      current = validators(**kwargs)
+      if current is None:
+        return f(payload, *args, **kwargs)
+
+      etag, last_modified = current
+      if is_not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+      else:
+        response = make_response(f(payload, *args, **kwargs))
+
+      response.set_etag(etag, weak=True)
+      response.last_modified = last_modified
+      return response
+    return wrapper
+  return conditional_get_decorator
+
+def is_not_modified(etag, last_modified):
+  if request.if_none_match:
+    return request.if_none_match.contains_weak(etag)
+  if request.if_modified_since:
+    return last_modified.replace(microsecond=0) <= request.if_modified_since
+  return False
+
+def table_validators(*names):
+  versions = table_versions(names)
+  if len(versions) != len(names):
+    return None
+  etag = '-'.join('{}.{}'.format(version.name, version.version) for version in versions)
+  return etag, max(version.updated_at for version in versions)
+
+def row_validators(model, id, *names):
+  updated_at = db.session.query(model.updated_at).filter(model.id == id).scalar()
+  if updated_at is None:
+    return None
+
+  etag = '{}.{}.{}'.format(model.__tablename__, id, updated_at.isoformat())
+  last_modified = updated_at
+  if names:
+    tables = table_validators(*names)
+    if tables is None:
+      return None
+    etag = etag + '-' + tables[0]
+    last_modified = max(last_modified, tables[1])
+  return etag, last_modified
+
+def movies_validators():
+  return table_validators('Movie')
+
+def actors_validators():
+  return table_validators('Actor')
+
+def movie_validators(id):
+  # the roles of a movie are covered by its updated_at; embedded actors are not
+  if 'actors' in get_expand(request):
+    return row_validators(Movie, id, 'Actor')
+  return row_validators(Movie, id)
+
+def actor_validators(id):
+  if 'movies' in get_expand(request):
+    return row_validators(Actor, id, 'Movie', 'MovieRoles')
+  return row_validators(Actor, id)
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    app.config.from_mapping(
+        RESPONSE_CACHE_BACKEND=os.environ.get('RESPONSE_CACHE_BACKEND', 'local'),
+        RESPONSE_CACHE_URL=os.environ.get('RESPONSE_CACHE_URL'),
+        RESPONSE_CACHE_SIZE=int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)),
+        RESPONSE_CACHE_TTL=int(os.environ.get('RESPONSE_CACHE_TTL', 60)),
+        METRICS_ENABLED=os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+        QUERY_TRACKING=os.environ.get('QUERY_TRACKING', 'off')
+    )
+    if test_config is not None:
+        app.config.update(test_config)
+
     setup_db(app)
+    init_response_cache(app)
+    init_metrics(app)
+    init_query_tracking(app)
     CORS(app)
 
     @app.route('/movies')
+    @query_budget(3)
     @requires_auth('get:movies')
+    @conditional_get(movies_validators)
+    @cached_response('Movie')
     def retrieve_movies(payload):
-        selection = Movie.query.order_by(Movie.id).all()
-        current_movies = paginate_items(request, selection)
+        if 'ids' in request.args:
+            return batch_get_response(request, Movie, get_ids(request.args['ids']))
+
+        fields = get_fields(request, Movie)
+        count_mode = get_count_mode(request)
+        selection = Movie.query
+        if 'cursor' in request.args:
+            current_movies, next_cursor = paginate_items_by_cursor(request, selection, Movie.id, fields)
+        else:
+            current_movies = paginate_items(request, selection.order_by(Movie.id), fields)
+            next_cursor = None
 
         if len(current_movies) == 0:
           abort(404)
 
         try:
-            return jsonify({
+            return json_response(add_total({
             'success': True,
-            'movies': current_movies
-            })
+            'movies': current_movies,
+            'next_cursor': next_cursor
+            }, 'movies', table_total(Movie, count_mode)))
         except:
             sys.exc_info()
             abort(404)
 
+    @app.route('/movies/lookup', methods=['POST'])
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @cached_response('Movie')
+    def lookup_movies(payload):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+
+        return batch_get_response(request, Movie, get_ids(body.get('ids')))
+
     @app.route('/movies/<int:id>', methods=['GET'])
+    @query_budget(5)
     @requires_auth('patch:movies')
+    @conditional_get(movie_validators)
+    @cached_response('Movie', 'MovieRoles', 'Actor')
     def get_movie(payload, id):
+        fields = get_fields(request, Movie)
+
         try:
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
-            roles = MovieRoles.query.filter(MovieRoles.movie_id == id).all()
-            roles = [role.format() for role in roles]
+            expand_actors = 'actors' in get_expand(request)
+            load_roles = selectinload(Movie.roles)
+            if expand_actors:
+                load_roles = load_roles.joinedload(MovieRoles.actor)
+
+            movie = Movie.query.options(load_only(*fields), load_roles).filter(Movie.id == id).one_or_none()
 
             if movie is None:
                 abort(404)
 
+            if expand_actors:
+                roles = [dict(role.format(), actor=role.actor.format()) for role in movie.roles]
+            else:
+                roles = [role.format() for role in movie.roles]
+
             return jsonify({
                 'success': True,
-                'movie': movie.format(),
+                'movie': movie.format(fields),
                 'roles': roles
             })
 
@@ -63,33 +432,26 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/movies/<int:id>', methods=['DELETE'])
+    @query_budget(5)
     @requires_auth('delete:movies')
     def delete_movie(payload, id):
         try:
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
-
-            if movie is None:
-                abort(404)
+            item = None
+            if get_return_preference(request) == 'representation':
+                movie = Movie.query.get(id)
+                item = movie.format() if movie is not None else None
 
-            roles = MovieRoles.query.filter(MovieRoles.movie_id == id).all()
-            for role in roles:
-                role.delete()
+            with unit_of_work():
+                if Movie.delete_by_id(id) == 0:
+                    abort(404)
 
-            movie.delete()
-            selection = Movie.query.order_by(Movie.id).all()
-            current_movies = paginate_items(request, selection)
-
-            return jsonify({
-                'success': True,
-                'deleted': id,
-                'movies': current_movies,
-                'total_movies': len(Movie.query.all())
-            })
+            return write_response(request, Movie, 'deleted', id, item)
 
         except:
             abort(422)
 
     @app.route('/movies', methods=['POST'])
+    @query_budget(8)
     @requires_auth('post:movies')
     def create_movie(payload):
         body = request.get_json()
@@ -101,58 +463,69 @@ def create_app(test_config=None):
         new_description = body.get('description', None)
 
         try:
-            movie = Movie(title=new_title, release_date=new_release_date, image_url=new_image_url, description=new_description)
-            movie.insert()
-
-            if(len(new_roles)):
-                for role in new_roles:
-                    new_role = MovieRoles(actor_id=role['actor_id'], movie_id=movie.id, role=role['role'])
-                    new_role.insert()
+            with unit_of_work():
+                movie = Movie(title=new_title, release_date=new_release_date, image_url=new_image_url, description=new_description)
+                movie.insert()
 
-            selection = Movie.query.order_by(Movie.id).all()
-            current_movies = paginate_items(request, selection)
+                if new_roles:
+                    MovieRoles.insert_many(movie.id, new_roles)
 
-            return jsonify({
-                'success': True,
-                'created': new_role.id,
-                'movies': current_movies,
-                'total_movies': len(Movie.query.all())
-            })
+            return write_response(request, Movie, 'created', movie.id, movie.format())
 
         except:
             abort(422)
 
+    @app.route('/movies/export')
+    @query_budget(allow_repeats=True)
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_response(request, Movie)
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @query_budget(allow_repeats=True)
+    @time_budget(BULK_IMPORT_TIME_BUDGET)
+    @requires_auth('post:movies')
+    def bulk_import_movies(payload):
+        report = import_movies(request.stream, get_chunk_size(request))
+
+        return jsonify(dict(report.format(), success=True))
+
+    @app.route('/movies', methods=['PATCH'])
+    @query_budget(allow_repeats=True)
+    @time_budget(BULK_IMPORT_TIME_BUDGET)
+    @requires_auth('patch:movies')
+    def batch_update_movies(payload):
+        return batch_update_response(request, Movie)
+
     @app.route('/movies/<int:id>', methods=['PATCH'])
+    @query_budget(8)
     @requires_auth('patch:movies')
     def update_movie(payload, id):
         try:
             body = request.get_json()
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
 
-            if movie is None:
-                abort(404)
-           
-            if 'title' in body:
-                movie.title = body.get('title', None)
-            if 'release_date' in body:
-                movie.release_date = body.get('release_date', None)
-            if 'image_url' in body:
-                movie.image_url = body.get('image_url', None)
-            if 'description' in body:
-                movie.description = body.get('description', None)
+            with unit_of_work():
+                movie = Movie.query.filter(Movie.id == id).one_or_none()
+
+                if movie is None:
+                    abort(404)
 
-            if 'roles' in body:
-                editedRoles = body.get('roles', None)
-                roles = MovieRoles.query.filter(MovieRoles.movie_id == id).all()
-                for role in roles:
-                    role.delete()
+                if 'title' in body:
+                    movie.title = body.get('title', None)
+                if 'release_date' in body:
+                    movie.release_date = body.get('release_date', None)
+                if 'image_url' in body:
+                    movie.image_url = body.get('image_url', None)
+                if 'description' in body:
+                    movie.description = body.get('description', None)
 
-                for role in editedRoles:
-                    new_role = MovieRoles(actor_id=role['actor_id'], movie_id=id, role=role['role'])
-                    new_role.insert()
+                if 'roles' in body:
+                    MovieRoles.reconcile(id, body.get('roles', None))
 
+                movie.update()
 
-            movie.update()
+            if get_return_preference(request) is not None:
+                return write_response(request, Movie, 'updated', id, movie.format())
 
             return jsonify({
                 'success': True,
@@ -163,84 +536,131 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/movies/search', methods=['POST'])
+    # on postgres one of them is the SET LOCAL of the time budget
+    @query_budget(4)
+    @time_budget(SEARCH_TIME_BUDGET)
+    @cached_response('Movie')
     def search_movie():
         body = request.get_json()
 
         searchTerm = body.get('searchTerm', None)
-        search = "%{}%".format(searchTerm)
+        fields = get_fields(request, Movie)
+        count_mode = get_count_mode(request)
+        # a keyset over id would page through the matches out of rank order
+        if 'cursor' in request.args:
+            abort(400)
 
         try:
-            selection = Movie.query.filter(Movie.title.ilike(search)).all()
-            current_movies = paginate_items(request, selection)
+            selection, ranking, count_query = search_items(Movie, searchTerm)
+            current_movies = paginate_items(request, selection.order_by(*ranking), fields)
 
-            return jsonify({
+            return json_response(add_total({
                 'success': True,
-                'movies': current_movies,
-                'total_movies': len(current_movies)
-            })
+                'movies': current_movies
+            }, 'movies', query_total(selection, count_query, count_mode)))
 
+        except HTTPException:
+            # a bad cursor is a 400, not an unprocessable search
+            raise
         except:
             abort(422)
 
     @app.route('/actors')
+    @query_budget(3)
     @requires_auth('get:actors')
+    @conditional_get(actors_validators)
+    @cached_response('Actor')
     def retrieve_actors(payload):
-        selection = Actor.query.order_by(Actor.id).all()
-        current_actors = paginate_items(request, selection)
+        if 'ids' in request.args:
+            return batch_get_response(request, Actor, get_ids(request.args['ids']))
+
+        fields = get_fields(request, Actor)
+        count_mode = get_count_mode(request)
+        selection = Actor.query
+        if 'cursor' in request.args:
+            current_actors, next_cursor = paginate_items_by_cursor(request, selection, Actor.id, fields)
+        else:
+            current_actors = paginate_items(request, selection.order_by(Actor.id), fields)
+            next_cursor = None
 
         if len(current_actors) == 0:
             abort(404)
 
-        return jsonify({
+        return json_response(add_total({
         'success': True,
-        'actors': current_actors
-        })
+        'actors': current_actors,
+        'next_cursor': next_cursor
+        }, 'actors', table_total(Actor, count_mode)))
+
+    @app.route('/actors/lookup', methods=['POST'])
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @cached_response('Actor')
+    def lookup_actors(payload):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+
+        return batch_get_response(request, Actor, get_ids(body.get('ids')))
 
     @app.route('/actors/<int:id>', methods=['GET'])
+    @query_budget(5)
     @requires_auth('patch:actors')
+    @conditional_get(actor_validators)
+    @cached_response('Actor', 'MovieRoles', 'Movie')
     def get_actor(payload, id):
+        fields = get_fields(request, Actor)
+
         try:
-            actor = Actor.query.filter(Actor.id == id).one_or_none()
+            if 'movies' not in get_expand(request):
+                actor = Actor.query.options(load_only(*fields)).filter(Actor.id == id).one_or_none()
+
+                if actor is None:
+                    abort(404)
+
+                return jsonify({
+                    'success': True,
+                    'actor': actor.format(fields)
+                })
+
+            actor = Actor.query.options(
+                load_only(*fields),
+                selectinload(Actor.roles).joinedload(MovieRoles.movie)
+            ).filter(Actor.id == id).one_or_none()
 
             if actor is None:
                 abort(404)
 
             return jsonify({
                 'success': True,
-                'actor': actor.format()
+                'actor': actor.format(fields),
+                'roles': [dict(role.format(), movie=role.movie.format()) for role in actor.roles]
             })
 
         except:
             abort(422)
 
     @app.route('/actors/<int:id>', methods=['DELETE'])
+    @query_budget(6)
     @requires_auth('delete:actors')
     def delete_actor(payload, id):
         try:
-            actor = Actor.query.filter(Actor.id == id).one_or_none()
+            item = None
+            if get_return_preference(request) == 'representation':
+                actor = Actor.query.get(id)
+                item = actor.format() if actor is not None else None
 
-            if actor is None:
-                abort(404)
-
-            roles = MovieRoles.query.filter(MovieRoles.actor_id == id).all()
-            for role in roles:
-                role.delete()
+            with unit_of_work():
+                if Actor.delete_by_id(id) == 0:
+                    abort(404)
 
-            actor.delete()
-            selection = Actor.query.order_by(Actor.id).all()
-            current_actors = paginate_items(request, selection)
-
-            return jsonify({
-                'success': True,
-                'deleted': id,
-                'actors': current_actors,
-                'total_actors': len(Actor.query.all())
-            })
+            return write_response(request, Actor, 'deleted', id, item)
 
         except:
             abort(422)
 
     @app.route('/actors', methods=['POST'])
+    @query_budget(5)
     @requires_auth('post:actors')
     def create_actor(payload):
         body = request.get_json()
@@ -252,44 +672,65 @@ def create_app(test_config=None):
         new_about = body.get('about', None)
 
         try:
-            actor = Actor(name=new_name, age=new_age, gender=new_gender, image_url=new_image_url, about=new_about)
-            actor.insert()
+            with unit_of_work():
+                actor = Actor(name=new_name, age=new_age, gender=new_gender, image_url=new_image_url, about=new_about)
+                actor.insert()
 
-            selection = Actor.query.order_by(Actor.id).all()
-            current_actors = paginate_items(request, selection)
-            
-            return jsonify({
-                'success': True,
-                'created': actor.id,
-                'actors': current_actors,
-                'total_actors': len(Actor.query.all())
-            })
+            return write_response(request, Actor, 'created', actor.id, actor.format())
 
         except:
             abort(422)
 
+    @app.route('/actors/export')
+    @query_budget(allow_repeats=True)
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_response(request, Actor)
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @query_budget(allow_repeats=True)
+    @time_budget(BULK_IMPORT_TIME_BUDGET)
+    @requires_auth('post:actors')
+    def bulk_import_actors(payload):
+        report = import_actors(request.stream, get_chunk_size(request))
+
+        return jsonify(dict(report.format(), success=True))
+
+    @app.route('/actors', methods=['PATCH'])
+    @query_budget(allow_repeats=True)
+    @time_budget(BULK_IMPORT_TIME_BUDGET)
+    @requires_auth('patch:actors')
+    def batch_update_actors(payload):
+        return batch_update_response(request, Actor)
+
     @app.route('/actors/<int:id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth('patch:actors')
     def update_actor(payload,id):
         try:
             body = request.get_json()
-            actor = Actor.query.filter(Actor.id == id).one_or_none()
 
-            if actor is None:
-                abort(404)
+            with unit_of_work():
+                actor = Actor.query.filter(Actor.id == id).one_or_none()
+
+                if actor is None:
+                    abort(404)
 
-            if 'name' in body:
-                actor.name = body.get('name', None)
-            if 'age' in body:
-                actor.age = body.get('age', None)
-            if 'gender' in body:
-                actor.gender = body.get('gender', None)
-            if 'gender' in body:
-                actor.image_url = body.get('image_url', None)
-            if 'about' in body:
-                actor.about = body.get('about', None)
+                if 'name' in body:
+                    actor.name = body.get('name', None)
+                if 'age' in body:
+                    actor.age = body.get('age', None)
+                if 'gender' in body:
+                    actor.gender = body.get('gender', None)
+                if 'gender' in body:
+                    actor.image_url = body.get('image_url', None)
+                if 'about' in body:
+                    actor.about = body.get('about', None)
 
-            actor.update()
+                actor.update()
+
+            if get_return_preference(request) is not None:
+                return write_response(request, Actor, 'updated', id, actor.format())
 
             return jsonify({
                 'success': True,
@@ -300,25 +741,72 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/actors/search', methods=['POST'])
+    # on postgres one of them is the SET LOCAL of the time budget
+    @query_budget(4)
+    @time_budget(SEARCH_TIME_BUDGET)
+    @cached_response('Actor')
     def search_actor():
         body = request.get_json()
 
         searchTerm = body.get('searchTerm', None)
-        search = "%{}%".format(searchTerm)
+        fields = get_fields(request, Actor)
+        count_mode = get_count_mode(request)
+        # a keyset over id would page through the matches out of rank order
+        if 'cursor' in request.args:
+            abort(400)
 
         try:
-            selection = Actor.query.filter(Actor.name.ilike(search)).all()
-            current_actors = paginate_items(request, selection)
+            selection, ranking, count_query = search_items(Actor, searchTerm)
+            current_actors = paginate_items(request, selection.order_by(*ranking), fields)
 
-            return jsonify({
+            return json_response(add_total({
                 'success': True,
-                'actors': current_actors,
-                'total_actors': len(current_actors)
-            })
+                'actors': current_actors
+            }, 'actors', query_total(selection, count_query, count_mode)))
 
+        except HTTPException:
+            # a bad cursor is a 400, not an unprocessable search
+            raise
         except:
             abort(422)
 
+    @app.route('/health')
+    @query_budget(1)
+    def health():
+        db.session.execute('SELECT 1')
+        replicas = app.extensions.get('read_replicas')
+        return jsonify({
+            'success': True,
+            'pool': dict(pool_stats.stats(), status=db.engine.pool.status()),
+            'replicas': replicas.stats() if replicas else []
+        })
+
+    @app.route('/metrics')
+    @query_budget(0)
+    def metrics():
+        if not app.config['METRICS_ENABLED']:
+            abort(404)
+
+        pool = pool_stats.stats()
+        tokens = token_cache.stats()
+        keys = jwks_cache.stats()
+        gauges = {
+            'db_pool_checkouts': ('Connections checked out of the pool', pool['checkouts']),
+            'db_pool_checkout_timeouts': ('Checkouts that timed out waiting for a connection', pool['timeouts']),
+            'db_pool_checkout_wait_seconds': ('Total time spent waiting for a pooled connection', pool['total_wait_seconds']),
+            'db_pool_checkout_wait_max_seconds': ('Longest wait for a pooled connection', pool['max_wait_seconds']),
+            'auth_token_cache_hits': ('Bearer tokens served from the verified token cache', tokens['hits']),
+            'auth_token_cache_misses': ('Bearer tokens that had to be verified', tokens['misses']),
+            'auth_jwks_fetches': ('JWKS fetches', keys['fetches']),
+            'auth_jwks_fetch_failures': ('Failed JWKS fetches', keys['failures'])
+        }
+        cache = app.extensions['response_cache']
+        if cache is not None:
+            responses = cache.stats()
+            gauges['response_cache_hits'] = ('Responses served from the response cache', responses['hits'])
+            gauges['response_cache_misses'] = ('Responses the response cache did not have', responses['misses'])
+        return Response(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
     @app.errorhandler(404)
     def not_found_error(error):
         return jsonify({
@@ -332,9 +820,26 @@ def create_app(test_config=None):
         return jsonify({
         'success': False,
         'error': 500,
-        'message': error['error']
+        'message': "internal server error"
         }), 500
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+        'success': False,
+        'error': 503,
+        'message': "database timeout, try again later"
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+    @app.errorhandler(PoolTimeoutError)
+    @app.errorhandler(DBAPIError)
+    def database_error(error):
+        if is_timeout_error(error):
+            return service_unavailable(error)
+        return server_error(error)
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
@@ -377,10 +882,13 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def not_processable(error):
+        # the handlers turn any exception into a 422, a database timeout included
+        if is_timeout_error(error.__context__):
+            return service_unavailable(error)
         return jsonify({
         'success': False,
         'error': 422,
-        'message': error['error']
+        'message': "unprocessible entity"
         }), 422
 
     @app.errorhandler(AuthError)
@@ -1,13 +1,23 @@
 import json
+import hashlib
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 import os
+import threading
+import time
+from metrics import timed
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFETCH_INTERVAL = int(os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 ## AuthError Exception
 '''
@@ -20,6 +30,172 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS key store
+'''
+JWKSCache
+    keeps the parsed Auth0 signing keys in memory, shared by every request in the worker
+
+    keys are served from memory while younger than the ttl. once stale they are still
+    served while a background thread refreshes them. fetches of any kind, the first
+    one, a background refresh or a refetch for a token with an unknown kid, start at
+    most once per min_refetch_interval, so a failing endpoint is not retried by every
+    request. a request arriving while a synchronous fetch is in flight waits for it
+    instead of failing. a fetch gives up after timeout seconds, and a failed one keeps
+    serving the last good key set
+'''
+class JWKSCache:
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL, timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt_at = None
+        self.refreshing = False
+        self.fetches = 0
+        self.failures = 0
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+    def fetch(self):
+        with self.lock:
+            self.last_attempt_at = time.monotonic()
+            self.fetches += 1
+        try:
+            jsonurl = urlopen(self.url, timeout=self.timeout)
+            jwks = json.loads(jsonurl.read())
+            keys = {key['kid']: key for key in jwks['keys']}
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            return False
+
+        with self.lock:
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+        return True
+
+    def claim_fetch(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.last_attempt_at is not None and now - self.last_attempt_at < self.min_refetch_interval:
+                return False
+            self.last_attempt_at = now
+            return True
+
+    def fetch_if_due(self):
+        with self.fetch_lock:
+            if self.claim_fetch():
+                self.fetch()
+
+    def background_refresh(self):
+        try:
+            self.fetch()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def refresh_if_stale(self):
+        if self.fetched_at is None or self.refreshing or time.monotonic() - self.fetched_at <= self.ttl:
+            return
+        # after a failed refresh the next one waits out min_refetch_interval
+        if self.claim_fetch():
+            with self.lock:
+                self.refreshing = True
+            threading.Thread(target=self.background_refresh, daemon=True).start()
+
+    def get_key(self, kid):
+        if self.fetched_at is None:
+            self.fetch_if_due()
+        else:
+            self.refresh_if_stale()
+
+        key = self.keys.get(kid)
+        if key is not None:
+            with self.lock:
+                self.hits += 1
+            return key
+
+        self.fetch_if_due()
+        return self.keys.get(kid)
+
+    def stats(self):
+        return {
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'hits': self.hits,
+            'keys': len(self.keys)
+        }
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+## Verified token cache
+'''
+TokenCache
+    bounded LRU of verified token payloads, keyed by the sha256 of the token,
+    so a repeated bearer token skips the RS256 verification
+
+    an entry is only served until the token's exp and while its signing kid is
+    still in the JWKS, which verify_decode_jwt keeps refreshing on cache hits too.
+    tokens without an exp claim are never cached
+'''
+class TokenCache:
+    def __init__(self, jwks, max_size=TOKEN_CACHE_SIZE):
+        self.jwks = jwks
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def digest(self, token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        digest = self.digest(token)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, kid, exp = entry
+            if exp <= time.time() or kid not in self.jwks.keys:
+                del self.entries[digest]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def set(self, token, kid, payload):
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.max_size <= 0:
+            return
+
+        digest = self.digest(token)
+        with self.lock:
+            self.entries[digest] = (payload, kid, exp)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'max_size': self.max_size
+        }
+
+token_cache = TokenCache(jwks_cache)
+
 ## Auth Header
 
 '''
@@ -93,16 +269,22 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using the Auth0 /.well-known/jwks.json keys held by jwks_cache
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
+    a token verified earlier is served from token_cache until its exp, or until
+    its kid leaves the JWKS, which is refreshed here once stale
 
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # a cache hit skips get_key, so the key set would otherwise never be refreshed
+    jwks_cache.refresh_if_stale()
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -111,15 +293,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = jwks_cache.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -130,6 +312,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            token_cache.set(token, rsa_key['kid'], payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -167,13 +350,14 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
+            with timed('auth'):
+                token = get_token_auth_header()
+                try:
+                    payload = verify_decode_jwt(token)
+                except:
+                    abort(401)
 
-            check_permissions(permission, payload)
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,323 @@
+'''
+Load test of the API: a mixed workload of list, detail, search and write
+requests at a fixed concurrency, against a local database and a local JWKS
+
+    python benchmarks/load_test.py --movies 5000 --actors 2000 --concurrency 8 \
+        --duration 30 --output results.json --baseline benchmarks/baseline.json
+
+Starts the app from create_app on a throwaway SQLite database (or --database-url),
+serves the signing key in benchmarks/keys/jwks.json from a local JWKS server and
+signs its own tokens, so it needs neither Postgres nor Auth0. The key in
+benchmarks/keys is for benchmarking only.
+
+Writes p50/p95/p99 latency, error count and throughput of successful requests
+per endpoint to --output as JSON. Only 2xx and 304 responses count as successful.
+With --baseline, compares p95, throughput and errors against a saved result and
+exits with status 1 when an endpoint got slower than --tolerance allows or
+failed more often.
+'''
+import argparse
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+KEYS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keys')
+DOMAIN = 'benchmark.local'
+AUDIENCE = 'agency'
+KID = 'benchmark'
+PERMISSIONS = [
+    'get:movies', 'get:actors', 'post:movies', 'post:actors',
+    'patch:movies', 'patch:actors', 'delete:movies', 'delete:actors'
+]
+
+# (name, weight) of each request in the mix
+WORKLOAD = (
+    ('list_movies', 25),
+    ('list_movies_cursor', 10),
+    ('get_movie', 15),
+    ('list_actors', 15),
+    ('get_actor', 10),
+    ('search_movies', 10),
+    ('search_actors', 5),
+    ('create_actor', 5),
+    ('update_movie', 5)
+)
+
+# every request in the mix should succeed, so anything else, a 404 or a 422
+# from a broken write included, is counted as an error
+OK_STATUSES = frozenset(range(200, 300)) | {304}
+
+
+## Local JWKS
+class JWKSHandler(http.server.BaseHTTPRequestHandler):
+    jwks = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.jwks)))
+        self.end_headers()
+        self.wfile.write(self.jwks)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_jwks_server():
+    with open(os.path.join(KEYS_DIR, 'jwks.json'), 'rb') as f:
+        JWKSHandler.jwks = f.read()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), JWKSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_environment(args, jwks_server):
+    # auth.auth reads its settings at import, so they are set before the app is imported
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['AUTH0_DOMAIN'] = DOMAIN
+    os.environ['ALGORITHMS'] = 'RS256'
+    os.environ['API_AUDIENCE'] = AUDIENCE
+    os.environ['JWKS_URL'] = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(jwks_server.server_port)
+    if args.no_cache:
+        os.environ['RESPONSE_CACHE_BACKEND'] = 'none'
+
+
+def make_token():
+    from jose import jwt
+
+    with open(os.path.join(KEYS_DIR, 'benchmark_key.pem')) as f:
+        key = f.read()
+    now = int(time.time())
+    claims = {
+        'iss': 'https://{}/'.format(DOMAIN),
+        'sub': 'benchmark',
+        'aud': AUDIENCE,
+        'iat': now,
+        'exp': now + 24 * 3600,
+        'permissions': PERMISSIONS
+    }
+    return jwt.encode(claims, key, algorithm='RS256', headers={'kid': KID})
+
+
+## Workload
+class Client:
+    def __init__(self, base_url, token, movie_ids, actor_ids, search_terms, rng):
+        self.base_url = base_url
+        self.search_terms = search_terms
+        self.token = token
+        self.movie_ids = movie_ids
+        self.actor_ids = actor_ids
+        self.rng = rng
+        self.pages = max(1, len(movie_ids) // 10)
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers={
+            'Authorization': 'Bearer ' + self.token,
+            'Content-Type': 'application/json'
+        })
+        try:
+            with urllib.request.urlopen(req) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def list_movies(self):
+        return self.request('GET', '/movies?page={}'.format(self.rng.randint(1, self.pages)))
+
+    def list_movies_cursor(self):
+        return self.request('GET', '/movies?cursor=&per_page=20')
+
+    def get_movie(self):
+        return self.request('GET', '/movies/{}'.format(self.rng.choice(self.movie_ids)))
+
+    def list_actors(self):
+        return self.request('GET', '/actors?page={}'.format(self.rng.randint(1, max(1, len(self.actor_ids) // 10))))
+
+    def get_actor(self):
+        return self.request('GET', '/actors/{}?expand=movies'.format(self.rng.choice(self.actor_ids)))
+
+    def search_movies(self):
+        return self.request('POST', '/movies/search', {'searchTerm': self.rng.choice(self.search_terms['movies'])})
+
+    def search_actors(self):
+        return self.request('POST', '/actors/search', {'searchTerm': self.rng.choice(self.search_terms['actors'])})
+
+    def create_actor(self):
+        return self.request('POST', '/actors', {'name': 'New actor', 'age': 30, 'gender': 'female', 'image_url': '', 'about': ''})
+
+    def update_movie(self):
+        return self.request('PATCH', '/movies/{}'.format(self.rng.choice(self.movie_ids)), {'title': 'Renamed {}'.format(self.rng.random())})
+
+
+def worker(client, deadline, requests_left, samples, lock):
+    names = [name for name, weight in WORKLOAD]
+    weights = [weight for name, weight in WORKLOAD]
+    while time.monotonic() < deadline:
+        with lock:
+            if requests_left[0] == 0:
+                return
+            requests_left[0] -= 1
+
+        name = client.rng.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            status = getattr(client, name)()
+        except OSError:
+            status = None
+        elapsed = time.perf_counter() - start
+
+        with lock:
+            samples.setdefault(name, []).append((elapsed, status in OK_STATUSES))
+
+
+## Reporting
+def percentile(values, p):
+    index = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(samples, elapsed):
+    endpoints = {}
+    for name, results in sorted(samples.items()):
+        latencies = sorted(latency * 1000 for latency, ok in results)
+        errors = sum(1 for latency, ok in results if not ok)
+        endpoints[name] = {
+            'requests': len(results),
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'throughput_rps': round((len(results) - errors) / elapsed, 3)
+        }
+    return endpoints
+
+
+def compare(endpoints, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(endpoints.items()):
+        before = baseline.get('endpoints', {}).get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.1f} ms, baseline {:.1f} ms'.format(name, result['p95_ms'], before['p95_ms']))
+        if result['errors'] > before.get('errors', 0):
+            regressions.append('{}: {} errors, baseline {}'.format(name, result['errors'], before.get('errors', 0)))
+        if result['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} req/s, baseline {:.1f} req/s'.format(name, result['throughput_rps'], before['throughput_rps']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'load_test.db'))
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--cast-size', type=float, default=8, help='mean number of roles per movie')
+    parser.add_argument('--no-seed', action='store_true', help='use the data already in --database-url, e.g. from manage.py generate')
+    parser.add_argument('--no-cache', action='store_true', help='turn the response cache off')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--requests', type=int, default=-1, help='stop after this many requests')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='load_test.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    jwks_server = start_jwks_server()
+    configure_environment(args, jwks_server)
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from app import create_app
+    from models import db, Movie, Actor
+    from generate import generate_catalogue, WORDS, FIRST_NAMES
+
+    app = create_app()
+    with app.app_context():
+        if not args.no_seed:
+            generate_catalogue(args.movies, args.actors, cast_size=args.cast_size, seed=args.seed)
+        movie_ids = [id for (id,) in db.session.query(Movie.id)]
+        actor_ids = [id for (id,) in db.session.query(Actor.id)]
+        db.session.remove()
+
+    if not movie_ids or not actor_ids:
+        parser.error('the database needs at least one movie and one actor')
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+    token = make_token()
+    search_terms = {'movies': WORDS, 'actors': FIRST_NAMES}
+
+    samples = {}
+    lock = threading.Lock()
+    requests_left = [args.requests]
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(
+            Client(base_url, token, movie_ids, actor_ids, search_terms, random.Random(args.seed + n)),
+            deadline, requests_left, samples, lock))
+        for n in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    jwks_server.shutdown()
+
+    endpoints = summarize(samples, elapsed)
+    result = {
+        'config': {
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+            'movies': len(movie_ids),
+            'actors': len(actor_ids),
+            'concurrency': args.concurrency,
+            'duration_seconds': round(elapsed, 3),
+            'seed': args.seed,
+            'cast_size': args.cast_size,
+            'cache': not args.no_cache
+        },
+        'total': {
+            'requests': sum(endpoint['requests'] for endpoint in endpoints.values()),
+            'errors': sum(endpoint['errors'] for endpoint in endpoints.values()),
+            'throughput_rps': round(sum(1 for results in samples.values() for latency, ok in results if ok) / elapsed, 3)
+        },
+        'endpoints': endpoints
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+    print('{:<20} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for name, endpoint in endpoints.items():
+        print('{:<20} {requests:>8} {errors:>7} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} {throughput_rps:>9.1f}'.format(name, **endpoint))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(endpoints, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('regression ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
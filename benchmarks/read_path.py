@@ -0,0 +1,73 @@
+'''
+Compares the ORM format() read path with the read model path of read_models.py
+
+    python benchmarks/read_path.py --rows 20000 --per-page 100 --pages 200
+
+Seeds a throwaway SQLite database, then serializes the same pages both ways.
+'''
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'read_path.db'))
+
+from flask import Flask, jsonify
+from models import setup_db, db, Movie
+from read_models import read_rows, json_response
+
+
+def seed(rows):
+    now = datetime.datetime(2021, 6, 7)
+    db.session.execute(Movie.__table__.delete())
+    for start in range(0, rows, 1000):
+        db.session.execute(Movie.__table__.insert().values([
+            {'title': 'Movie {}'.format(i), 'release_date': now, 'image_url': 'https://example.com/{}.jpg'.format(i),
+             'description': 'A description of movie {} '.format(i) * 8}
+            for i in range(start, min(start + 1000, rows))]))
+    db.session.commit()
+
+
+def format_path(page, per_page):
+    selection = Movie.query.order_by(Movie.id).offset((page - 1) * per_page).limit(per_page).all()
+    response = jsonify({'success': True, 'movies': [movie.format() for movie in selection]})
+    db.session.expunge_all()
+    return response.get_data()
+
+
+def read_model_path(page, per_page):
+    selection = Movie.query.order_by(Movie.id).offset((page - 1) * per_page).limit(per_page)
+    return json_response({'success': True, 'movies': read_rows(selection)}).get_data()
+
+
+def measure(path, pages, per_page):
+    start = time.perf_counter()
+    for page in range(1, pages + 1):
+        path(page, per_page)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app)
+    with app.app_context():
+        seed(args.rows)
+        pages = min(args.pages, args.rows // args.per_page)
+
+        for name, path in (('format()', format_path), ('read model', read_model_path)):
+            path(1, args.per_page)
+            elapsed = measure(path, pages, args.per_page)
+            print('{:<12} {:8.1f} ms total {:8.3f} ms/page'.format(name, elapsed * 1000, elapsed * 1000 / pages))
+
+
+if __name__ == '__main__':
+    main()
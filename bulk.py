@@ -0,0 +1,378 @@
+import os
+import json
+import datetime
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import SQLAlchemyError
+from dateutil import parser as date_parser
+from models import db, unit_of_work, TableVersion, TableCount, Movie, Actor, MovieRoles
+from read_models import id_filter
+
+'''
+Streaming NDJSON import for movies and actors
+
+The request body is read one line at a time and validated as it arrives.
+Valid records are written in chunks of chunk_size rows, each chunk with
+multi-row INSERTs in its own transaction, so memory stays bounded by the
+chunk size however large the upload is. Invalid lines are skipped and
+reported by line number.
+
+Batch updates take a list of {id, changes} items and apply them in a single
+transaction. Items changing the same set of columns are written together: on
+Postgres with one UPDATE ... FROM (VALUES ...) per UPDATE_PAGE_SIZE items,
+elsewhere with an executemany UPDATE.
+'''
+
+BULK_IMPORT_CHUNK_SIZE = int(os.environ.get('BULK_IMPORT_CHUNK_SIZE', 1000))
+MAX_BULK_IMPORT_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+MAX_BATCH_UPDATE_SIZE = int(os.environ.get('MAX_BATCH_UPDATE_SIZE', 10000))
+# rows per UPDATE ... FROM (VALUES ...), well within the Postgres parameter limit
+UPDATE_PAGE_SIZE = 1000
+# ids looked up per SELECT, within the bound parameter limit of SQLite
+ID_LOOKUP_CHUNK_SIZE = 900
+
+class RecordError(ValueError):
+  pass
+
+## Validation
+def optional_string(record, key):
+  value = record.get(key)
+  if value is not None and not isinstance(value, str):
+    raise RecordError('{} must be a string'.format(key))
+  return value
+
+def required_string(record, key):
+  value = record.get(key)
+  if not isinstance(value, str) or not value:
+    raise RecordError('{} is required'.format(key))
+  return value
+
+def parse_release_date(value):
+  if value is None:
+    return None
+  if not isinstance(value, str):
+    raise RecordError('release_date must be a date string')
+  try:
+    return date_parser.parse(value)
+  except (ValueError, OverflowError):
+    raise RecordError('release_date is not a valid date')
+
+def validate_roles(roles):
+  if roles is None:
+    return []
+  if not isinstance(roles, list):
+    raise RecordError('roles must be a list')
+
+  for role in roles:
+    if not isinstance(role, dict) or type(role.get('actor_id')) is not int:
+      raise RecordError('each role needs an integer actor_id')
+    if role.get('role') is not None and not isinstance(role.get('role'), str):
+      raise RecordError('role must be a string')
+  # a movie casts an actor in a given role once
+  unique = dict.fromkeys((role['actor_id'], role.get('role')) for role in roles)
+  return [{'actor_id': actor_id, 'role': role} for actor_id, role in unique]
+
+def validate_movie(record):
+  return {
+    'title': required_string(record, 'title'),
+    'release_date': parse_release_date(record.get('release_date')),
+    'image_url': optional_string(record, 'image_url'),
+    'description': optional_string(record, 'description')
+  }, validate_roles(record.get('roles'))
+
+def required_age(record, key):
+  age = record.get(key)
+  if type(age) is not int or age < 0:
+    raise RecordError('{} must be a non-negative integer'.format(key))
+  return age
+
+def validate_actor(record):
+  return {
+    'name': required_string(record, 'name'),
+    'age': required_age(record, 'age'),
+    'gender': required_string(record, 'gender'),
+    'image_url': optional_string(record, 'image_url'),
+    'about': optional_string(record, 'about')
+  }, None
+
+## Reading
+'''
+read_records(stream, validate)
+    yields (line number, validated record, error) for every non-blank line
+'''
+def read_records(stream, validate):
+  for number, line in enumerate(stream, 1):
+    line = line.strip()
+    if not line:
+      continue
+
+    try:
+      record = json.loads(line)
+      if not isinstance(record, dict):
+        raise RecordError('record must be a JSON object')
+      yield number, validate(record), None
+    except ValueError as e:
+      yield number, None, str(e)
+
+def chunked(records, size):
+  chunk = []
+  for record in records:
+    chunk.append(record)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+## Writing
+def insert_rows(table, rows, batch_size):
+  for start in range(0, len(rows), batch_size):
+    db.session.execute(table.insert().values(rows[start:start + batch_size]))
+
+def insert_movies(rows):
+  table = Movie.__table__
+  if db.session.get_bind().dialect.name == 'postgresql':
+    result = db.session.execute(table.insert().values(rows).returning(table.c.id))
+    return [row[0] for row in result]
+
+  # without RETURNING the generated ids are only known one row at a time
+  return [db.session.execute(table.insert().values(row)).inserted_primary_key[0] for row in rows]
+
+'''
+ImportReport
+    counts imported and failed lines and keeps the first MAX_REPORTED_ERRORS errors
+'''
+class ImportReport:
+  def __init__(self):
+    self.imported = 0
+    self.failed = 0
+    self.errors = []
+
+  def add_error(self, line, error):
+    self.failed += 1
+    if len(self.errors) < MAX_REPORTED_ERRORS:
+      self.errors.append({'line': line, 'error': error})
+
+  def add_chunk_error(self, chunk):
+    for number, record, error in chunk:
+      if error is None:
+        self.add_error(number, 'the chunk containing this line could not be written')
+
+  def format(self):
+    return {
+      'imported': self.imported,
+      'failed': self.failed,
+      'errors': self.errors
+    }
+
+def import_actors(stream, chunk_size=BULK_IMPORT_CHUNK_SIZE):
+  report = ImportReport()
+
+  for chunk in chunked(read_records(stream, validate_actor), chunk_size):
+    rows = []
+    for number, record, error in chunk:
+      if error is not None:
+        report.add_error(number, error)
+      else:
+        rows.append(record[0])
+
+    if rows:
+      try:
+        with unit_of_work():
+          insert_rows(Actor.__table__, rows, chunk_size)
+          TableVersion.bump('Actor')
+          TableCount.add('Actor', len(rows))
+        report.imported += len(rows)
+      except SQLAlchemyError:
+        report.add_chunk_error(chunk)
+
+  return report
+
+def import_movies(stream, chunk_size=BULK_IMPORT_CHUNK_SIZE):
+  report = ImportReport()
+
+  for chunk in chunked(read_records(stream, validate_movie), chunk_size):
+    referenced = {role['actor_id'] for number, record, error in chunk if error is None for role in record[1]}
+    existing = set()
+    if referenced:
+      existing = {id for (id,) in db.session.query(Actor.id).filter(Actor.id.in_(referenced))}
+
+    movies = []
+    for number, record, error in chunk:
+      if error is None:
+        missing = {role['actor_id'] for role in record[1]} - existing
+        if missing:
+          error = 'unknown actor_id {}'.format(', '.join(str(id) for id in sorted(missing)))
+
+      if error is not None:
+        report.add_error(number, error)
+      else:
+        movies.append(record)
+
+    if movies:
+      try:
+        with unit_of_work():
+          ids = insert_movies([movie for movie, roles in movies])
+          roles = [dict(role, movie_id=id) for id, (movie, movie_roles) in zip(ids, movies) for role in movie_roles]
+          insert_rows(MovieRoles.__table__, roles, chunk_size)
+          TableVersion.bump('Movie', 'MovieRoles')
+          TableCount.add('Movie', len(movies))
+        report.imported += len(movies)
+      except SQLAlchemyError:
+        report.add_chunk_error(chunk)
+
+  return report
+
+## Batch updates
+# the columns a batch update may change, with their validators
+UPDATABLE_COLUMNS = {
+  Movie: {
+    'title': required_string,
+    'release_date': lambda changes, key: parse_release_date(changes.get(key)),
+    'image_url': optional_string,
+    'description': optional_string
+  },
+  Actor: {
+    'name': required_string,
+    'age': required_age,
+    'gender': required_string,
+    'image_url': optional_string,
+    'about': optional_string
+  }
+}
+
+def validate_update(model, item):
+  if not isinstance(item, dict) or type(item.get('id')) is not int:
+    raise RecordError('each item needs an integer id')
+
+  changes = item.get('changes')
+  if not isinstance(changes, dict) or not changes:
+    raise RecordError('changes must be a non-empty object')
+
+  columns = UPDATABLE_COLUMNS[model]
+  unknown = set(changes) - set(columns)
+  if unknown:
+    raise RecordError('cannot change ' + ', '.join(sorted(unknown)))
+  return {key: columns[key](changes, key) for key in changes}
+
+def existing_ids(model, ids):
+  existing = set()
+  for start in range(0, len(ids), ID_LOOKUP_CHUNK_SIZE):
+    chunk = ids[start:start + ID_LOOKUP_CHUNK_SIZE]
+    existing.update(id for (id,) in db.session.query(model.id).filter(id_filter(model, chunk)))
+  return existing
+
+'''
+update_from_values(table, columns, rows, dialect)
+    sets the columns of every row in one statement, joining the table to the
+    new values: UPDATE ... SET ... FROM (VALUES (:row_id, ...), ...) AS v
+'''
+def update_from_values(table, columns, rows, dialect):
+  names = ('row_id',) + columns
+  values = []
+  params = {'updated_at': datetime.datetime.utcnow()}
+  for number, row in enumerate(rows):
+    values.append('({})'.format(', '.join(':{}_{}'.format(name, number) for name in names)))
+    params.update({'{}_{}'.format(name, number): row[name] for name in names})
+
+  # a VALUES list has no column types of its own, so each value is cast to its column's
+  assignments = ', '.join('"{0}" = CAST(v."{0}" AS {1})'.format(column, table.c[column].type.compile(dialect)) for column in columns)
+  db.session.execute(text(
+    'UPDATE "{table}" SET {assignments}, updated_at = :updated_at '
+    'FROM (VALUES {values}) AS v ({names}) WHERE "{table}".id = v.row_id'.format(
+      table=table.name, assignments=assignments, values=', '.join(values),
+      names=', '.join('"{}"'.format(name) for name in names))), params)
+
+def update_rows(table, updates):
+  groups = {}
+  for id, changes in updates:
+    groups.setdefault(tuple(sorted(changes)), []).append(dict(changes, row_id=id))
+
+  dialect = db.session.get_bind().dialect
+  for columns, rows in groups.items():
+    if dialect.name == 'postgresql':
+      for start in range(0, len(rows), UPDATE_PAGE_SIZE):
+        update_from_values(table, columns, rows[start:start + UPDATE_PAGE_SIZE], dialect)
+    else:
+      statement = table.update().where(table.c.id == bindparam('row_id')).values(
+        {column: bindparam(column) for column in columns})
+      db.session.execute(statement, rows)
+
+'''
+UpdateReport
+    the result of every item of a batch update, in the order they were sent
+'''
+class UpdateReport:
+  def __init__(self):
+    self.results = []
+
+  def add(self, id, status, error=None):
+    result = {'id': id, 'status': status}
+    if error is not None:
+      result['error'] = error
+    self.results.append(result)
+
+  def count(self, status):
+    return sum(1 for result in self.results if result['status'] == status)
+
+  @property
+  def failed(self):
+    return len(self.results) - self.count('updated')
+
+  def format(self):
+    return {
+      'updated': self.count('updated'),
+      'failed': self.failed,
+      'results': self.results
+    }
+
+'''
+update_many(model, items, atomic)
+    applies a list of {id, changes} items in one transaction. invalid items and
+    unknown ids are reported and skipped, or with atomic=True fail the whole
+    batch without writing anything
+'''
+def update_many(model, items, atomic=False):
+  report = UpdateReport()
+  checked = []
+  seen = set()
+  for item in items:
+    id = item.get('id') if isinstance(item, dict) else None
+    try:
+      changes = validate_update(model, item)
+      if id in seen:
+        raise RecordError('id {} appears more than once'.format(id))
+      seen.add(id)
+      checked.append((id, changes, None))
+    except RecordError as e:
+      checked.append((id, None, str(e)))
+
+  existing = existing_ids(model, [id for id, changes, error in checked if error is None])
+  updates = []
+  for id, changes, error in checked:
+    if error is not None:
+      report.add(id, 'invalid', error)
+    elif id not in existing:
+      report.add(id, 'not_found')
+    else:
+      report.add(id, 'updated')
+      updates.append((id, changes))
+
+  if atomic and report.failed:
+    for result in report.results:
+      if result['status'] == 'updated':
+        result['status'] = 'skipped'
+    return report
+
+  if updates:
+    try:
+      with unit_of_work():
+        update_rows(model.__table__, updates)
+        TableVersion.bump(model.__tablename__)
+    except SQLAlchemyError:
+      for result in report.results:
+        if result['status'] == 'updated':
+          result['status'] = 'failed'
+          result['error'] = 'the batch could not be written'
+
+  return report
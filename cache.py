@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, current_app, make_response, g
+from models import TableVersion
+
+'''
+Response cache for the read endpoints
+
+Entries are keyed by the route, its arguments, the search body and the
+TableVersion generation of every table the response is built from. A write
+bumps those generations in its transaction, so entries it affects are never
+served again and simply age out of the backend.
+'''
+
+## Backends
+'''
+LocalCache
+    in-process LRU of response bodies bounded by entry count and ttl
+'''
+class LocalCache:
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'max_size': self.max_size
+        }
+
+'''
+SharedCache
+    keeps response bodies in a key-value store shared by every worker. client is
+    a redis.Redis or anything with the same get(key) / set(key, value, ex=ttl)
+'''
+class SharedCache:
+    def __init__(self, client, ttl=60, prefix='agency:response:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+'''
+create_cache(config)
+    builds the backend named by RESPONSE_CACHE_BACKEND ('local', 'redis' or 'none').
+    a ready backend can be passed as RESPONSE_CACHE instead
+'''
+def create_cache(config):
+    if config.get('RESPONSE_CACHE') is not None:
+        return config['RESPONSE_CACHE']
+
+    backend = config.get('RESPONSE_CACHE_BACKEND', 'local')
+    ttl = int(config.get('RESPONSE_CACHE_TTL', 60))
+
+    if backend == 'none':
+        return None
+    if backend == 'redis':
+        import redis
+        return SharedCache(redis.Redis.from_url(config['RESPONSE_CACHE_URL']), ttl=ttl)
+    return LocalCache(max_size=int(config.get('RESPONSE_CACHE_SIZE', 1024)), ttl=ttl)
+
+'''
+init_response_cache(app)
+    builds the app's cache backend and forgets the table versions of the
+    previous request before each new one
+'''
+def init_response_cache(app):
+    app.extensions['response_cache'] = create_cache(app.config)
+    app.before_request(forget_table_versions)
+
+def forget_table_versions():
+    g.pop('table_versions', None)
+
+'''
+table_versions(names)
+    the TableVersion rows of the given tables, ordered by name. a request keeps
+    those it has read on g, so the conditional GET check and the cache key
+    share one query
+'''
+def table_versions(names):
+    known = g.setdefault('table_versions', {})
+    missing = set(names) - set(known)
+    if missing:
+        for version in TableVersion.query.filter(TableVersion.name.in_(missing)):
+            known[version.name] = version
+    return [known[name] for name in sorted(set(names)) if name in known]
+
+## Decorator
+def cache_key(tables):
+    versions = table_versions(tables)
+    generation = ','.join('{}.{}'.format(version.name, version.version) for version in versions)
+    arguments = '&'.join('{}={}'.format(name, value) for name, value in sorted(request.args.items(multi=True)))
+
+    key = hashlib.sha256()
+    for part in (request.method, request.path, arguments, generation):
+        key.update(part.encode())
+        key.update(b'\0')
+    key.update(request.get_data())
+    return key.hexdigest()
+
+'''
+cached_response(*tables)
+    serves the view's 200 JSON response from the app's response cache while
+    none of the given tables changed. stack it below requires_auth so the
+    permission check runs before a cached body is returned
+'''
+def cached_response(*tables):
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None:
+                return f(*args, **kwargs)
+
+            key = cache_key(tables)
+            body = cache.get(key)
+            if body is not None:
+                return current_app.response_class(body, mimetype='application/json')
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, response.get_data())
+            return response
+        return wrapper
+    return cached_response_decorator
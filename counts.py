@@ -0,0 +1,71 @@
+import json
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from models import db, TableCount
+
+'''
+Row counts for list and search responses
+
+A table's total is read from its TableCount row, which inserts and deletes keep
+exact in the same transaction, so it costs a one row read instead of a scan.
+A search total is counted by the database, as it depends on the term.
+
+With ?count=estimate, Postgres answers from planner statistics instead:
+pg_class.reltuples for a table, and the planner's row estimate for a search,
+neither of which touches the rows. They are as fresh as the last ANALYZE, so
+a response marks its total as estimated. Elsewhere, and on a table that has
+never been analyzed, the exact count is used. ?count=none skips the count.
+'''
+
+COUNT_MODES = ('exact', 'estimate', 'none')
+
+class Explain(Executable, ClauseElement):
+  def __init__(self, statement):
+    self.statement = statement
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+  return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+def is_postgresql():
+  return db.session.get_bind().dialect.name == 'postgresql'
+
+def estimate_table_rows(model):
+  estimate = db.session.execute(
+    text('SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+    {'table': '"{}"'.format(model.__tablename__)}).scalar()
+  # reltuples is -1 (0 before Postgres 14) until the table is first analyzed
+  return int(estimate) if estimate is not None and estimate > 0 else None
+
+def estimate_query_rows(query):
+  plan = db.session.execute(Explain(query.statement)).scalar()
+  if isinstance(plan, str):
+    plan = json.loads(plan)
+  return int(plan[0]['Plan']['Plan Rows'])
+
+'''
+table_total(model, mode)
+    the number of rows in the model's table and whether it is an estimate.
+    None with mode 'none'
+'''
+def table_total(model, mode='exact'):
+  if mode == 'none':
+    return None, False
+  if mode == 'estimate' and is_postgresql():
+    estimate = estimate_table_rows(model)
+    if estimate is not None:
+      return estimate, True
+  return TableCount.get(model.__tablename__), False
+
+'''
+query_total(selection, count_query, mode)
+    the number of rows selection matches and whether it is an estimate.
+    count_query counts them exactly and only runs when needed
+'''
+def query_total(selection, count_query, mode='exact'):
+  if mode == 'none':
+    return None, False
+  if mode == 'estimate' and is_postgresql():
+    return estimate_query_rows(selection), True
+  return count_query.scalar(), False
@@ -0,0 +1,67 @@
+import os
+import zlib
+from flask import json
+from sqlalchemy.orm import load_only
+from models import db, Movie, Actor, MovieRoles
+
+'''
+Streaming NDJSON export for movies and actors
+
+Rows are read through a server-side cursor (stream_results + yield_per) and
+every chunk is written to the response as soon as it is read, so memory stays
+flat however large the table is. Roles, when embedded, are fetched with one
+query per chunk.
+'''
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+
+ROLE_KEYS = {
+  Movie: MovieRoles.movie_id,
+  Actor: MovieRoles.actor_id
+}
+
+def read_chunks(model, fields, chunk_size):
+  selection = model.query.options(load_only(*fields)).order_by(model.id) \
+    .execution_options(stream_results=True).yield_per(chunk_size)
+
+  chunk = []
+  for item in selection:
+    chunk.append(item)
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def roles_by_owner(model, ids):
+  key = ROLE_KEYS[model]
+  roles = {id: [] for id in ids}
+  for role in MovieRoles.query.filter(key.in_(ids)).order_by(MovieRoles.id):
+    roles[getattr(role, key.key)].append(role.format())
+  return roles
+
+'''
+export_lines(model, with_roles, fields, chunk_size)
+    yields the whole table as NDJSON, one string per chunk of rows, with only
+    the given format() columns (all of them by default)
+'''
+def export_lines(model, with_roles=False, fields=None, chunk_size=EXPORT_CHUNK_SIZE):
+  fields = fields or model.FIELDS
+  for chunk in read_chunks(model, fields, chunk_size):
+    items = [item.format(fields) for item in chunk]
+    if with_roles:
+      roles = roles_by_owner(model, [item['id'] for item in items])
+      for item in items:
+        item['roles'] = roles[item['id']]
+
+    # the identity map would otherwise keep every exported row alive
+    db.session.expunge_all()
+    yield ''.join(json.dumps(item) + '\n' for item in items)
+
+def gzip_lines(lines):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  for line in lines:
+    data = compressor.compress(line.encode())
+    if data:
+      yield data
+  yield compressor.flush()
@@ -0,0 +1,151 @@
+import io
+import csv
+import math
+import time
+import random
+import datetime
+import itertools
+from models import db, unit_of_work, TableVersion, TableCount, COUNTED_TABLES, Movie, Actor, MovieRoles
+
+'''
+Synthetic catalogue generator
+
+Generates movies, actors and roles with configurable, skewed distributions and
+loads them in batches: COPY on Postgres, an executemany INSERT elsewhere, one
+transaction per batch. The same seed and options always produce the same rows.
+
+Cast sizes follow a log-normal distribution around cast_size, so most movies
+have a small cast and a few have a very large one. Actors are cast with Zipf
+weights, 1 / rank ** actor_skew, so a handful of popular actors appear in a
+large share of the movies.
+'''
+
+GENDERS = ('female', 'male', 'non-binary')
+WORDS = (
+  'frog', 'princess', 'river', 'night', 'city', 'storm', 'garden', 'king',
+  'robot', 'island', 'winter', 'ghost', 'dragon', 'summer', 'letter', 'road'
+)
+FIRST_NAMES = ('Ama', 'Kofi', 'Maria', 'Chen', 'Sam', 'Lena', 'Ravi', 'Ines', 'Tomas', 'Yaw', 'Noor', 'Eli')
+LAST_NAMES = ('Mensah', 'Garcia', 'Smith', 'Okafor', 'Kim', 'Rossi', 'Novak', 'Haddad', 'Silva', 'Boateng')
+
+## Rows
+def movie_rows(rng, first_id, count, from_date, to_date, now):
+  days = (to_date - from_date).days
+  for id in range(first_id, first_id + count):
+    words = rng.sample(WORDS, 3)
+    yield {
+      'id': id,
+      'title': 'The {} {} {}'.format(*words).title(),
+      'release_date': from_date + datetime.timedelta(days=rng.randint(0, days)),
+      'image_url': 'https://example.com/movies/{}.jpg'.format(id),
+      'description': 'A story about a {}, a {} and a {}.'.format(*rng.sample(WORDS, 3)),
+      'updated_at': now
+    }
+
+def actor_rows(rng, first_id, count, now):
+  for id in range(first_id, first_id + count):
+    yield {
+      'id': id,
+      'name': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+      'age': rng.randint(8, 90),
+      'gender': rng.choice(GENDERS),
+      'image_url': 'https://example.com/actors/{}.jpg'.format(id),
+      'about': 'Known for playing a {}.'.format(rng.choice(WORDS)),
+      'updated_at': now
+    }
+
+def pick_cast_size(rng, mean, skew, max_size):
+  mu = math.log(mean) - skew ** 2 / 2
+  return max(1, min(max_size, int(round(rng.lognormvariate(mu, skew)))))
+
+def role_rows(rng, movie_ids, actor_ids, mean_cast_size, cast_skew, max_cast_size, actor_skew, now):
+  cum_weights = list(itertools.accumulate(1.0 / (rank ** actor_skew) for rank in range(1, len(actor_ids) + 1)))
+  for movie_id in movie_ids:
+    size = pick_cast_size(rng, mean_cast_size, cast_skew, max_cast_size)
+    for number, actor_id in enumerate(rng.choices(actor_ids, cum_weights=cum_weights, k=size), 1):
+      yield {'movie_id': movie_id, 'actor_id': actor_id, 'role': 'Role {}'.format(number), 'updated_at': now}
+
+## Loading
+def batches(rows, size):
+  iterator = iter(rows)
+  while True:
+    batch = list(itertools.islice(iterator, size))
+    if not batch:
+      return
+    yield batch
+
+def copy_rows(table, columns, rows):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  for row in rows:
+    writer.writerow([row[column] for column in columns])
+  buffer.seek(0)
+
+  cursor = db.session.connection().connection.cursor()
+  cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+    table.name, ', '.join('"{}"'.format(column) for column in columns)), buffer)
+
+'''
+load_rows(table, rows, batch_size)
+    writes the rows in batches of batch_size, each in its own transaction
+    along with the table's row count if it keeps one, and returns how many
+    were written
+'''
+def load_rows(table, rows, batch_size):
+  postgres = db.session.get_bind().dialect.name == 'postgresql'
+  loaded = 0
+  for batch in batches(rows, batch_size):
+    with unit_of_work():
+      if postgres:
+        copy_rows(table, list(batch[0]), batch)
+      else:
+        db.session.execute(table.insert(), batch)
+      if table.name in COUNTED_TABLES:
+        TableCount.add(table.name, len(batch))
+    loaded += len(batch)
+  return loaded
+
+def next_id(model):
+  return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def reset_sequences(*models):
+  if db.session.get_bind().dialect.name != 'postgresql':
+    return
+  with unit_of_work():
+    for model in models:
+      db.session.execute(
+        "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), (SELECT max(id) FROM \"{0}\"))".format(model.__tablename__))
+
+'''
+generate_catalogue(movies, actors, ...)
+    generates and loads the catalogue, appending to what is already in the
+    database. returns the number of rows loaded per table
+'''
+def generate_catalogue(movies, actors, cast_size=8, cast_skew=1.0, max_cast_size=200, actor_skew=1.0,
+                       from_date=datetime.datetime(1950, 1, 1), to_date=datetime.datetime(2021, 12, 31),
+                       seed=0, batch_size=10000, log=None):
+  rng = random.Random(seed)
+  now = datetime.datetime.utcnow()
+  first_movie_id = next_id(Movie)
+  first_actor_id = next_id(Actor)
+  counts = {}
+
+  started = time.monotonic()
+  counts['Actor'] = load_rows(Actor.__table__, actor_rows(rng, first_actor_id, actors, now), batch_size)
+  if log:
+    log('{} actors in {:.1f}s'.format(counts['Actor'], time.monotonic() - started))
+
+  counts['Movie'] = load_rows(Movie.__table__, movie_rows(rng, first_movie_id, movies, from_date, to_date, now), batch_size)
+  if log:
+    log('{} movies in {:.1f}s'.format(counts['Movie'], time.monotonic() - started))
+
+  roles = role_rows(rng, range(first_movie_id, first_movie_id + movies), range(first_actor_id, first_actor_id + actors),
+    cast_size, cast_skew, max_cast_size, actor_skew, now) if actors else ()
+  counts['MovieRoles'] = load_rows(MovieRoles.__table__, roles, batch_size)
+  if log:
+    log('{} roles in {:.1f}s'.format(counts['MovieRoles'], time.monotonic() - started))
+
+  reset_sequences(Movie, Actor)
+  with unit_of_work():
+    TableVersion.bump('Movie', 'Actor', 'MovieRoles')
+  return counts
@@ -1,14 +1,44 @@
+import datetime
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
+from flask import g
 from app import app
 from models import db
+from generate import generate_catalogue
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+'''
+python manage.py generate --movies 1000000 --actors 500000 --seed 42
+    loads a synthetic catalogue of movies, actors and roles. the same seed and
+    options always generate the same data
+'''
+@manager.option('--movies', dest='movies', type=int, default=10000)
+@manager.option('--actors', dest='actors', type=int, default=5000)
+@manager.option('--cast-size', dest='cast_size', type=float, default=8, help='mean number of roles per movie')
+@manager.option('--cast-skew', dest='cast_skew', type=float, default=1.0, help='spread of the log-normal cast size, 0 gives every movie the mean')
+@manager.option('--max-cast-size', dest='max_cast_size', type=int, default=200)
+@manager.option('--actor-skew', dest='actor_skew', type=float, default=1.0, help='Zipf exponent of actor popularity, 0 casts actors uniformly')
+@manager.option('--from-date', dest='from_date', type=parse_date, default='1950-01-01', help='earliest release date, YYYY-MM-DD')
+@manager.option('--to-date', dest='to_date', type=parse_date, default='2021-12-31', help='latest release date, YYYY-MM-DD')
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('--batch-size', dest='batch_size', type=int, default=10000)
+def generate(movies, actors, cast_size, cast_skew, max_cast_size, actor_skew, from_date, to_date, seed, batch_size):
+    """Generates a synthetic catalogue of movies, actors and roles"""
+    with app.app_context():
+        # the load runs far longer than the per-request DB_STATEMENT_TIMEOUT and DB_LOCK_TIMEOUT allow
+        g.statement_timeout = 0
+        g.lock_timeout = 0
+        generate_catalogue(movies, actors, cast_size=cast_size, cast_skew=cast_skew, max_cast_size=max_cast_size,
+            actor_skew=actor_skew, from_date=from_date, to_date=to_date, seed=seed, batch_size=batch_size, log=print)
+
 
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
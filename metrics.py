@@ -0,0 +1,170 @@
+import time
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Per-request timing and Prometheus metrics
+
+Every request records the time spent in auth, in SQL statements and in JSON
+serialization, the number of statements and the rows they returned. The
+breakdown is sent back in a Server-Timing header and added to per-route
+histograms, rendered in the Prometheus text format by render_metrics().
+
+Rows are counted as the driver reports them (psycopg2 does for SELECTs,
+sqlite3 does not). Metrics are kept per process, so with several gunicorn
+workers each worker is scraped on its own.
+'''
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+## Histograms
+'''
+Histogram(name, help, buckets)
+    a Prometheus histogram with one series per set of label values
+'''
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = sorted(self.series.items())
+            for labels, values in series:
+                for bound, count in zip(self.buckets, values):
+                    lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + (('le', format_value(bound)),)), count))
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + (('le', '+Inf'),)), values[-1]))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), format_value(values[-2])))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(labels), values[-1]))
+        return lines
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Request latency by route', LATENCY_BUCKETS)
+AUTH_DURATION = Histogram('http_request_auth_seconds', 'Time spent verifying the bearer token', LATENCY_BUCKETS)
+DB_DURATION = Histogram('http_request_db_seconds', 'Time spent in SQL statements', LATENCY_BUCKETS)
+SERIALIZE_DURATION = Histogram('http_request_serialize_seconds', 'Time spent encoding JSON', LATENCY_BUCKETS)
+QUERY_COUNT = Histogram('http_request_queries', 'SQL statements per request', QUERY_BUCKETS)
+ROW_COUNT = Histogram('http_request_rows', 'Rows returned by SQL statements per request', ROW_BUCKETS)
+RESPONSE_BYTES = Histogram('http_response_bytes', 'Response body size', BYTE_BUCKETS)
+
+HISTOGRAMS = (REQUEST_DURATION, AUTH_DURATION, DB_DURATION, SERIALIZE_DURATION, QUERY_COUNT, ROW_COUNT, RESPONSE_BYTES)
+
+## Request timing
+'''
+timed(phase)
+    adds the time spent in the block to the current request's phase
+'''
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and 'timings' in g:
+            g.timings[phase] += time.perf_counter() - start
+
+# the start time lives on the statement's execution context, which a failed
+# statement takes with it, rather than on the pooled connection
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_start', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'timings' in g:
+        g.timings['db'] += elapsed
+        g.queries += 1
+        if cursor.description is not None and cursor.rowcount > 0:
+            g.rows += cursor.rowcount
+
+def start_request():
+    g.started = time.perf_counter()
+    g.timings = {'auth': 0.0, 'db': 0.0, 'serialize': 0.0}
+    g.queries = 0
+    g.rows = 0
+
+def finish_request(response):
+    if 'timings' not in g:
+        return response
+
+    total = time.perf_counter() - g.started
+    timings = g.timings
+    response.headers['Server-Timing'] = ', '.join([
+        'auth;dur={:.2f}'.format(timings['auth'] * 1000),
+        'db;dur={:.2f};desc="{} queries"'.format(timings['db'] * 1000, g.queries),
+        'serialize;dur={:.2f}'.format(timings['serialize'] * 1000),
+        'total;dur={:.2f}'.format(total * 1000)
+    ])
+
+    labels = (('method', request.method), ('route', request.url_rule.rule if request.url_rule else 'unmatched'))
+    REQUEST_DURATION.observe(labels, total)
+    AUTH_DURATION.observe(labels, timings['auth'])
+    DB_DURATION.observe(labels, timings['db'])
+    SERIALIZE_DURATION.observe(labels, timings['serialize'])
+    QUERY_COUNT.observe(labels, g.queries)
+    ROW_COUNT.observe(labels, g.rows)
+    if not response.is_streamed:
+        RESPONSE_BYTES.observe(labels, response.calculate_content_length() or 0)
+    return response
+
+'''
+init_metrics(app)
+    times every request of the app and its JSON encoding, unless
+    METRICS_ENABLED is off
+'''
+def init_metrics(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    class TimedJSONEncoder(app.json_encoder):
+        def encode(self, o):
+            with timed('serialize'):
+                return super().encode(o)
+
+    app.json_encoder = TimedJSONEncoder
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+'''
+render_metrics(gauges)
+    the histograms, followed by the given {name: (help, value)} gauges, in
+    the Prometheus text format
+'''
+def render_metrics(gauges):
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for name, (help, value) in sorted(gauges.items()):
+        lines.extend(['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name), '{} {}'.format(name, format_value(value))])
+    return '\n'.join(lines) + '\n'
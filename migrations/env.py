@@ -73,6 +73,14 @@ def run_migrations_online():
     connectable = current_app.extensions['migrate'].db.engine
 
     with connectable.connect() as connection:
+        # index builds and data fixes run far longer than the statement_timeout
+        # and lock_timeout every pooled connection starts with. RESET puts those
+        # defaults back before the connection returns to the pool
+        postgres = connection.dialect.name == 'postgresql'
+        if postgres:
+            connection.execute('SET statement_timeout = 0')
+            connection.execute('SET lock_timeout = 0')
+
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
@@ -80,8 +88,13 @@ def run_migrations_online():
             **current_app.extensions['migrate'].configure_args
         )
 
-        with context.begin_transaction():
-            context.run_migrations()
+        try:
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            if postgres:
+                connection.execute('RESET statement_timeout')
+                connection.execute('RESET lock_timeout')
 
 
 if context.is_offline_mode():
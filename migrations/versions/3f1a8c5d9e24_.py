@@ -0,0 +1,67 @@
+"""search indexes for movies and actors
+
+Revision ID: 3f1a8c5d9e24
+Revises: 9c4d2e7a1b38
+Create Date: 2026-10-18 11:03:12.204876
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1a8c5d9e24'
+down_revision = '9c4d2e7a1b38'
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = {
+    'Movie': ('title', 'description'),
+    'Actor': ('name', 'about')
+}
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for table, columns in SEARCH_COLUMNS.items():
+            upgrade_sqlite(table, columns)
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, columns in SEARCH_COLUMNS.items():
+        for column in columns:
+            op.create_index('ix_{}_{}_trgm'.format(table, column), table, [column], unique=False,
+                            postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for table in SEARCH_COLUMNS:
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER IF EXISTS "{}_search_{}"'.format(table, trigger))
+            op.execute('DROP TABLE IF EXISTS "{}Search"'.format(table))
+        return
+
+    for table, columns in SEARCH_COLUMNS.items():
+        for column in columns:
+            op.drop_index('ix_{}_{}_trgm'.format(table, column), table_name=table)
+
+
+def upgrade_sqlite(table, columns):
+    index = table + 'Search'
+    names = ', '.join(columns)
+    new_values = ', '.join('new.' + column for column in columns)
+    old_values = ', '.join('old.' + column for column in columns)
+
+    op.execute(f'''CREATE VIRTUAL TABLE "{index}" USING fts5({names}, content='{table}', content_rowid='id', tokenize='trigram')''')
+    op.execute(f'''CREATE TRIGGER "{table}_search_insert" AFTER INSERT ON "{table}" BEGIN
+      INSERT INTO "{index}"(rowid, {names}) VALUES (new.id, {new_values});
+    END''')
+    op.execute(f'''CREATE TRIGGER "{table}_search_delete" AFTER DELETE ON "{table}" BEGIN
+      INSERT INTO "{index}"("{index}", rowid, {names}) VALUES ('delete', old.id, {old_values});
+    END''')
+    op.execute(f'''CREATE TRIGGER "{table}_search_update" AFTER UPDATE ON "{table}" BEGIN
+      INSERT INTO "{index}"("{index}", rowid, {names}) VALUES ('delete', old.id, {old_values});
+      INSERT INTO "{index}"(rowid, {names}) VALUES (new.id, {new_values});
+    END''')
+    op.execute(f'''INSERT INTO "{index}"("{index}") VALUES ('rebuild')''')
@@ -0,0 +1,41 @@
+"""cascade MovieRoles deletes and index its foreign keys
+
+Revision ID: 9c4d2e7a1b38
+Revises: 5ab3e316e149
+Create Date: 2026-10-18 10:12:40.512318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4d2e7a1b38'
+down_revision = '5ab3e316e149'
+branch_labels = None
+depends_on = None
+
+
+# SQLite can only change a foreign key by rebuilding the table, which batch mode
+# does. its reflected foreign keys are unnamed, so they get the names Postgres gives them
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def upgrade():
+    with op.batch_alter_table('MovieRoles', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint('MovieRoles_actor_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('MovieRoles_movie_id_fkey', type_='foreignkey')
+        batch_op.create_foreign_key('MovieRoles_actor_id_fkey', 'Actor', ['actor_id'], ['id'], ondelete='CASCADE')
+        batch_op.create_foreign_key('MovieRoles_movie_id_fkey', 'Movie', ['movie_id'], ['id'], ondelete='CASCADE')
+        batch_op.create_index(batch_op.f('ix_MovieRoles_actor_id'), ['actor_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_MovieRoles_movie_id'), ['movie_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('MovieRoles', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_MovieRoles_movie_id'))
+        batch_op.drop_index(batch_op.f('ix_MovieRoles_actor_id'))
+        batch_op.drop_constraint('MovieRoles_movie_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('MovieRoles_actor_id_fkey', type_='foreignkey')
+        batch_op.create_foreign_key('MovieRoles_movie_id_fkey', 'Movie', ['movie_id'], ['id'])
+        batch_op.create_foreign_key('MovieRoles_actor_id_fkey', 'Actor', ['actor_id'], ['id'])
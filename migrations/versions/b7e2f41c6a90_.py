@@ -0,0 +1,54 @@
+"""updated_at columns and table versions for conditional requests
+
+Revision ID: b7e2f41c6a90
+Revises: 3f1a8c5d9e24
+Create Date: 2026-10-18 12:20:47.331905
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2f41c6a90'
+down_revision = '3f1a8c5d9e24'
+branch_labels = None
+depends_on = None
+
+TABLES = ('Movie', 'Actor', 'MovieRoles')
+
+
+def upgrade():
+    now = datetime.datetime.utcnow()
+    bind = op.get_bind()
+
+    for table in TABLES:
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute(sa.table(table, sa.column('updated_at')).update().values(updated_at=now))
+        # SQLite cannot alter a column in place, and rebuilding Movie or Actor would
+        # cascade the delete of the old table to MovieRoles and drop the search triggers
+        if bind.dialect.name != 'sqlite':
+            op.alter_column(table, 'updated_at', nullable=False)
+
+    # manage.py imports the app, whose create_all has already created and seeded
+    # the table on a database that predates it
+    if 'TableVersion' in sa.inspect(bind).get_table_names():
+        return
+
+    table_version = op.create_table('TableVersion',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': name, 'version': 0, 'updated_at': now} for name in TABLES
+    ])
+
+
+def downgrade():
+    op.drop_table('TableVersion')
+    for table in reversed(TABLES):
+        op.drop_column(table, 'updated_at')
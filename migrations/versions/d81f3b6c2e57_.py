@@ -0,0 +1,37 @@
+"""row counts of movies and actors
+
+Revision ID: d81f3b6c2e57
+Revises: b7e2f41c6a90
+Create Date: 2026-10-18 15:02:11.804216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f3b6c2e57'
+down_revision = 'b7e2f41c6a90'
+branch_labels = None
+depends_on = None
+
+TABLES = ('Movie', 'Actor')
+
+
+def upgrade():
+    # manage.py imports the app, whose create_all has already created and seeded
+    # the table on a database that predates it
+    if 'TableCount' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table('TableCount',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('count', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    for table in TABLES:
+        op.execute('INSERT INTO "TableCount" (name, count) SELECT \'{0}\', count(*) FROM "{0}"'.format(table))
+
+
+def downgrade():
+    op.drop_table('TableCount')
@@ -0,0 +1,41 @@
+"""unique roles per movie and actor
+
+Revision ID: e4a9c7d3f815
+Revises: d81f3b6c2e57
+Create Date: 2026-10-18 16:40:03.517620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9c7d3f815'
+down_revision = 'd81f3b6c2e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest of any duplicated (movie_id, actor_id, role) rows. GROUP BY
+    # puts rows without a role in one group, so their duplicates go too
+    op.execute(
+        'DELETE FROM "MovieRoles" WHERE id NOT IN '
+        '(SELECT min(id) FROM "MovieRoles" GROUP BY movie_id, actor_id, role)'
+    )
+    # SQLite can only add a constraint by rebuilding the table, which batch mode does
+    with op.batch_alter_table('MovieRoles') as batch_op:
+        batch_op.create_unique_constraint('MovieRoles_movie_actor_role_key', ['movie_id', 'actor_id', 'role'])
+
+    # NULLs are distinct in the constraint, so rows without a role get a partial index
+    op.create_index('MovieRoles_movie_actor_null_role_key', 'MovieRoles', ['movie_id', 'actor_id'], unique=True,
+                    postgresql_where=sa.text('role IS NULL'), sqlite_where=sa.text('role IS NULL'))
+    # the constraint leads with movie_id, so it serves the lookups this index did
+    op.drop_index(op.f('ix_MovieRoles_movie_id'), table_name='MovieRoles')
+
+
+def downgrade():
+    op.create_index(op.f('ix_MovieRoles_movie_id'), 'MovieRoles', ['movie_id'], unique=False)
+    op.drop_index('MovieRoles_movie_actor_null_role_key', table_name='MovieRoles')
+    with op.batch_alter_table('MovieRoles') as batch_op:
+        batch_op.drop_constraint('MovieRoles_movie_actor_role_key', type_='unique')
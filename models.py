@@ -1,23 +1,369 @@
 import os
-from sqlalchemy import Column, String, create_engine, Integer
-from flask_sqlalchemy import SQLAlchemy
+import time
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import Column, String, create_engine, Integer, event, DDL, select, func, bindparam, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_path = os.environ['DATABASE_URL']
 
-db = SQLAlchemy()
+REPLICA_CHECK_INTERVAL = int(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+READ_METHODS = ('GET', 'HEAD')
+
+'''
+ReplicaSet(engines, check_interval)
+    hands out the read replicas round-robin. a replica is checked with a
+    SELECT 1 at most every check_interval seconds and skipped while it fails;
+    choose() returns None when no replica is healthy
+'''
+class ReplicaSet:
+  def __init__(self, engines, check_interval=REPLICA_CHECK_INTERVAL):
+    self.engines = engines
+    self.check_interval = check_interval
+    self.lock = threading.Lock()
+    self.next = 0
+    self.healthy = [True] * len(engines)
+    self.checked_at = [None] * len(engines)
+
+  def is_healthy(self, index):
+    now = time.monotonic()
+    checked_at = self.checked_at[index]
+    if checked_at is None or now - checked_at >= self.check_interval:
+      self.checked_at[index] = now
+      try:
+        with self.engines[index].connect() as connection:
+          connection.execute('SELECT 1')
+        self.healthy[index] = True
+      except SQLAlchemyError:
+        self.healthy[index] = False
+    return self.healthy[index]
+
+  def choose(self):
+    for _ in range(len(self.engines)):
+      with self.lock:
+        index = self.next
+        self.next = (index + 1) % len(self.engines)
+      if self.is_healthy(index):
+        return self.engines[index]
+    return None
+
+  def stats(self):
+    return [
+      {'url': repr(engine.url), 'healthy': healthy}
+      for engine, healthy in zip(self.engines, self.healthy)
+    ]
+
+'''
+RoutingSession
+    sends the statements of GET requests to a read replica, picked once per
+    request. anything else, and every statement of a GET request after it has
+    written, goes to the primary
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    replica = self.read_replica(clause)
+    if replica is not None:
+      return replica
+    return super().get_bind(mapper, clause)
+
+  def read_replica(self, clause):
+    replicas = self.app.extensions.get('read_replicas')
+    if replicas is None or not has_request_context() or request.method not in READ_METHODS:
+      return None
+
+    if self._flushing or isinstance(clause, UpdateBase):
+      g.wrote_to_primary = True
+    if g.get('wrote_to_primary'):
+      return None
+
+    if 'read_replica' not in g:
+      g.read_replica = replicas.choose()
+    return g.read_replica
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return sessionmaker(class_=RoutingSession, db=self, **options)
+
+# committed objects keep their loaded state, so serializing them after the
+# commit does not re-SELECT every attribute
+db = RoutingSQLAlchemy(session_options={'expire_on_commit': False})
+
+'''
+Connection pool and timeout settings, read from the app config and falling
+back to the environment. timeouts are in milliseconds, 0 turns them off
+'''
+DATABASE_SETTINGS = {
+  'DB_POOL_SIZE': 5,
+  'DB_MAX_OVERFLOW': 10,
+  'DB_POOL_TIMEOUT': 5,
+  'DB_POOL_RECYCLE': 1800,
+  'DB_POOL_PRE_PING': True,
+  'DB_STATEMENT_TIMEOUT': 5000,
+  'DB_LOCK_TIMEOUT': 2000
+}
+
+def database_setting(config, key):
+  default = DATABASE_SETTINGS[key]
+  value = config.get(key, os.environ.get(key, default))
+  if isinstance(default, bool):
+    return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+  return int(value)
+
+'''
+PoolStats
+    how long requests waited to check a connection out of the pool, and how
+    many gave up waiting
+'''
+class PoolStats:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.checkouts = 0
+      self.timeouts = 0
+      self.total_wait = 0.0
+      self.max_wait = 0.0
+
+  def record(self, wait, timed_out=False):
+    with self.lock:
+      if timed_out:
+        self.timeouts += 1
+      else:
+        self.checkouts += 1
+      self.total_wait += wait
+      self.max_wait = max(self.max_wait, wait)
+
+  def stats(self):
+    with self.lock:
+      waits = self.checkouts + self.timeouts
+      return {
+        'checkouts': self.checkouts,
+        'timeouts': self.timeouts,
+        'total_wait_seconds': round(self.total_wait, 6),
+        'mean_wait_seconds': round(self.total_wait / waits, 6) if waits else 0.0,
+        'max_wait_seconds': round(self.max_wait, 6)
+      }
+
+pool_stats = PoolStats()
+
+'''
+TimedQueuePool
+    a QueuePool that records how long each checkout waited for a connection
+'''
+class TimedQueuePool(QueuePool):
+  def _do_get(self):
+    start = time.monotonic()
+    try:
+      connection = super()._do_get()
+    except PoolTimeoutError:
+      pool_stats.record(time.monotonic() - start, timed_out=True)
+      raise
+    pool_stats.record(time.monotonic() - start)
+    return connection
+
+'''
+engine_options(config, database_path)
+    the SQLALCHEMY_ENGINE_OPTIONS for the database. postgres gets a bounded
+    pool and server side statement and lock timeouts; sqlite keeps the pool
+    SQLAlchemy picks for it, which takes no size arguments
+'''
+def engine_options(config, database_path):
+  options = {'pool_pre_ping': database_setting(config, 'DB_POOL_PRE_PING')}
+  if make_url(database_path).get_backend_name() != 'postgresql':
+    return options
+
+  options.update(
+    poolclass=TimedQueuePool,
+    pool_size=database_setting(config, 'DB_POOL_SIZE'),
+    max_overflow=database_setting(config, 'DB_MAX_OVERFLOW'),
+    pool_timeout=database_setting(config, 'DB_POOL_TIMEOUT'),
+    pool_recycle=database_setting(config, 'DB_POOL_RECYCLE'),
+    # executemany INSERTs become multi-row VALUES and other statements are sent in pages
+    executemany_mode='values',
+    connect_args={'options': '-c statement_timeout={} -c lock_timeout={}'.format(
+      database_setting(config, 'DB_STATEMENT_TIMEOUT'),
+      database_setting(config, 'DB_LOCK_TIMEOUT'))}
+  )
+  return options
+
+'''
+get_replica_paths(config)
+    the read replica URLs from DATABASE_REPLICA_URLS, a list or a comma
+    separated string, in the app config or the environment
+'''
+def get_replica_paths(config):
+  paths = config.get('DATABASE_REPLICA_URLS', os.environ.get('DATABASE_REPLICA_URLS', ''))
+  if isinstance(paths, str):
+    paths = paths.split(',')
+  return [path.strip() for path in paths if path.strip()]
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, and the read
+    replicas GET requests are served from, if any are configured
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, database_path)
     db.app = app
     db.init_app(app)
     db.create_all()
 
+    if replica_paths is None:
+        replica_paths = get_replica_paths(app.config)
+    app.extensions.pop('read_replicas', None)
+    if replica_paths:
+        engines = [create_engine(path, **engine_options(app.config, path)) for path in replica_paths]
+        app.extensions['read_replicas'] = ReplicaSet(engines)
+
+'''
+SQLite only enforces foreign keys, and so the ON DELETE CASCADE on
+MovieRoles, when asked to on each connection
+'''
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+'''
+a route's time budget (see time_budget in app.py) replaces the connection's
+statement_timeout for every transaction the request opens, and g.lock_timeout
+its lock_timeout. 0 lifts the limit, as bulk loads outside a request do.
+SET LOCAL lasts until that transaction ends, so the pooled connection goes
+back unchanged
+'''
+@event.listens_for(db.session, 'after_begin')
+def apply_statement_timeout(session, transaction, connection):
+  if not has_app_context() or connection.dialect.name != 'postgresql':
+    return
+  for setting in ('statement_timeout', 'lock_timeout'):
+    if g.get(setting) is not None:
+      connection.execute('SET LOCAL {} = {:d}'.format(setting, g.get(setting)))
+
+'''
+is_timeout_error(error)
+    True for errors that mean the database ran out of time rather than that
+    the request was wrong: no free pooled connection, or postgres cancelling a
+    statement (57014) or giving up on a lock (55P03)
+'''
+TIMEOUT_SQLSTATES = ('57014', '55P03')
+
+def is_timeout_error(error):
+  if isinstance(error, PoolTimeoutError):
+    return True
+  return isinstance(error, DBAPIError) and getattr(error.orig, 'pgcode', None) in TIMEOUT_SQLSTATES
+
+'''
+unit_of_work()
+    groups every write of a request into one transaction. the model helpers
+    below only stage changes in the session; the block commits once at the
+    end and rolls the whole request back if anything inside it fails
+'''
+@contextmanager
+def unit_of_work():
+    try:
+        yield db.session
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+'''
+TableVersion
+    one row per table holding a version counter and the time of the last write.
+    the model write helpers record the tables they change with bump(), and the
+    versions are raised once, just before the transaction commits, so reading
+    a single row tells whether anything in the table changed. that one UPDATE
+    locks the rows in name order, so writers touching overlapping tables
+    cannot deadlock, and holds them only for the commit
+'''
+class TableVersion(db.Model):
+  __tablename__ = 'TableVersion'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+  @classmethod
+  def bump(cls, *names):
+    db.session.info.setdefault('bumped_tables', set()).update(names)
+
+  @classmethod
+  def bump_pending(cls, session):
+    names = sorted(session.info.pop('bumped_tables', ()))
+    if not names:
+      return
+
+    table = cls.__table__
+    locked = select([table.c.name]).where(table.c.name.in_(names)).order_by(table.c.name).with_for_update()
+    session.execute(table.update().where(table.c.name.in_(locked)).values(
+      version=table.c.version + 1, updated_at=datetime.datetime.utcnow()))
+
+  @classmethod
+  def get(cls, name):
+    return cls.query.filter(cls.name == name).one_or_none()
+
+@event.listens_for(db.session, 'before_commit')
+def bump_table_versions(session):
+  TableVersion.bump_pending(session)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_table_versions(session):
+  session.info.pop('bumped_tables', None)
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def seed_table_versions(target, connection, **kw):
+  now = datetime.datetime.utcnow()
+  connection.execute(target.insert(), [
+    {'name': name, 'version': 0, 'updated_at': now} for name in ('Movie', 'Actor', 'MovieRoles')])
+
+'''
+TableCount
+    the number of rows in Movie and Actor, adjusted in the same transaction as
+    every insert and delete, so a total is a one row read instead of a scan.
+    rows missing after create_all are seeded from a count of the table
+'''
+COUNTED_TABLES = ('Movie', 'Actor')
+
+class TableCount(db.Model):
+  __tablename__ = 'TableCount'
+
+  name = Column(String, primary_key=True)
+  count = Column(db.BigInteger, nullable=False, default=0)
+
+  @classmethod
+  def add(cls, name, delta):
+    if delta:
+      cls.query.filter(cls.name == name).update({cls.count: cls.count + delta}, synchronize_session=False)
+
+  @classmethod
+  def get(cls, name):
+    return db.session.query(cls.count).filter(cls.name == name).scalar()
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def seed_table_counts(target, connection, **kw):
+  table = TableCount.__table__
+  existing = {name for (name,) in connection.execute(select([table.c.name]))}
+  for name in COUNTED_TABLES:
+    if name not in existing:
+      count = connection.execute(select([func.count()]).select_from(target.tables[name])).scalar()
+      connection.execute(table.insert(), {'name': name, 'count': count})
+
 '''
 Movie
 Have title and release date
@@ -30,6 +376,11 @@ class Movie(db.Model):
   release_date = db.Column(db.DateTime)
   image_url = Column(String)
   description = Column(String)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+  roles = db.relationship('MovieRoles', back_populates='movie', order_by='MovieRoles.id', passive_deletes=True)
+
+  # the columns format() returns, and that ?fields= may choose from
+  FIELDS = ('id', 'title', 'release_date', 'image_url', 'description')
 
   def __init__(self, title, release_date, image_url, description):
     self.title = title
@@ -39,22 +390,33 @@ class Movie(db.Model):
 
   def insert(self):
     db.session.add(self)
-    db.session.commit()
+    db.session.flush()
+    TableVersion.bump('Movie')
+    TableCount.add('Movie', 1)
   
   def update(self):
-    db.session.commit()
+    db.session.flush()
+    TableVersion.bump('Movie')
 
   def delete(self):
     db.session.delete(self)
-    db.session.commit()
+    db.session.flush()
+    TableVersion.bump('Movie', 'MovieRoles')
+    TableCount.add('Movie', -1)
 
-  def format(self):
-    return {
-      'id': self.id,
-      'title': self.title,
-      'release_date': self.release_date,
-      'image_url': self.image_url,
-      'description': self.description}
+  @classmethod
+  def delete_by_id(cls, id):
+    TableVersion.bump('Movie', 'MovieRoles')
+    deleted = cls.query.filter(cls.id == id).delete(synchronize_session=False)
+    TableCount.add('Movie', -deleted)
+    return deleted
+
+  @classmethod
+  def touch(cls, ids):
+    cls.query.filter(cls.id.in_(ids)).update({cls.updated_at: datetime.datetime.utcnow()}, synchronize_session=False)
+
+  def format(self, fields=FIELDS):
+    return {field: getattr(self, field) for field in fields}
 
 '''
 Actor
@@ -69,6 +431,10 @@ class Actor(db.Model):
   gender = Column(String, nullable=False)
   image_url = Column(String)
   about = Column(String)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+  roles = db.relationship('MovieRoles', back_populates='actor', order_by='MovieRoles.id', passive_deletes=True)
+
+  FIELDS = ('id', 'name', 'age', 'gender', 'image_url', 'about')
 
   def __init__(self, name, age, gender, image_url, about):
     self.name = name
@@ -79,31 +445,50 @@ class Actor(db.Model):
 
   def insert(self):
     db.session.add(self)
-    db.session.commit()
+    db.session.flush()
+    TableVersion.bump('Actor')
+    TableCount.add('Actor', 1)
   
   def update(self):
-    db.session.commit()
+    db.session.flush()
+    TableVersion.bump('Actor')
 
   def delete(self):
+    Movie.touch(db.session.query(MovieRoles.movie_id).filter(MovieRoles.actor_id == self.id).subquery())
     db.session.delete(self)
-    db.session.commit()
+    db.session.flush()
+    TableVersion.bump('Actor', 'MovieRoles')
+    TableCount.add('Actor', -1)
 
-  def format(self):
-    return {
-      'id': self.id,
-      'name': self.name,
-      'age': self.age,
-      'gender': self.gender,
-      'image_url': self.image_url,
-      'about': self.about}
+  @classmethod
+  def delete_by_id(cls, id):
+    # the cascade removes this actor's roles, which changes those movies' casts
+    Movie.touch(db.session.query(MovieRoles.movie_id).filter(MovieRoles.actor_id == id).subquery())
+    TableVersion.bump('Actor', 'MovieRoles')
+    deleted = cls.query.filter(cls.id == id).delete(synchronize_session=False)
+    TableCount.add('Actor', -deleted)
+    return deleted
+
+  def format(self, fields=FIELDS):
+    return {field: getattr(self, field) for field in fields}
 
 class MovieRoles(db.Model):
     __tablename__ = 'MovieRoles'
+    # NULLs are distinct in a unique constraint, so a cast entry without a role
+    # needs its own partial index. the constraint also serves lookups by movie_id
+    __table_args__ = (
+      db.UniqueConstraint('movie_id', 'actor_id', 'role', name='MovieRoles_movie_actor_role_key'),
+      db.Index('MovieRoles_movie_actor_null_role_key', 'movie_id', 'actor_id', unique=True,
+        postgresql_where=text('role IS NULL'), sqlite_where=text('role IS NULL')),
+    )
 
     id = Column(Integer, primary_key=True)
-    actor_id = Column(db.Integer, db.ForeignKey('Actor.id'), nullable=False)
-    movie_id = Column(db.Integer, db.ForeignKey('Movie.id'), nullable=False)
+    actor_id = Column(db.Integer, db.ForeignKey('Actor.id', ondelete='CASCADE'), nullable=False, index=True)
+    movie_id = Column(db.Integer, db.ForeignKey('Movie.id', ondelete='CASCADE'), nullable=False)
     role = Column(String)
+    updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    movie = db.relationship('Movie', back_populates='roles')
+    actor = db.relationship('Actor', back_populates='roles')
 
     def __init__(self,actor_id, movie_id, role):
       self.actor_id = actor_id
@@ -112,15 +497,104 @@ class MovieRoles(db.Model):
 
     def insert(self):
       db.session.add(self)
-      db.session.commit()
+      db.session.flush()
+      Movie.touch([self.movie_id])
+      TableVersion.bump('MovieRoles')
 
     def delete(self):
       db.session.delete(self)
-      db.session.commit()
+      db.session.flush()
+      Movie.touch([self.movie_id])
+      TableVersion.bump('MovieRoles')
+
+    @staticmethod
+    def unique_roles(roles):
+      return list(dict.fromkeys((role['actor_id'], role['role']) for role in roles))
+
+    @classmethod
+    def insert_many(cls, movie_id, roles):
+      now = datetime.datetime.utcnow()
+      rows = [{'actor_id': actor_id, 'movie_id': movie_id, 'role': role, 'updated_at': now} for actor_id, role in cls.unique_roles(roles)]
+      if rows:
+        db.session.execute(cls.__table__.insert().values(rows))
+        Movie.touch([movie_id])
+        TableVersion.bump('MovieRoles')
+
+    '''
+    reconcile(movie_id, roles)
+        makes the movie's cast match roles with as few writes as possible. rows
+        are keyed by (actor_id, role): those in both are left alone, a removed
+        and an added role of the same actor become an UPDATE of the role, and
+        the rest are deleted or inserted, each kind in one statement. returns
+        the number of rows inserted, updated and deleted
+    '''
+    @classmethod
+    def reconcile(cls, movie_id, roles):
+      table = cls.__table__
+      stored = db.session.query(cls.id, cls.actor_id, cls.role).filter(cls.movie_id == movie_id).order_by(cls.id).all()
+      submitted = cls.unique_roles(roles)
+      kept = set(submitted) & {(actor_id, role) for id, actor_id, role in stored}
+
+      removed = {}
+      for id, actor_id, role in stored:
+        if (actor_id, role) not in kept:
+          removed.setdefault(actor_id, []).append(id)
+
+      now = datetime.datetime.utcnow()
+      updated, inserted = [], []
+      for actor_id, role in submitted:
+        if (actor_id, role) in kept:
+          continue
+        if removed.get(actor_id):
+          updated.append({'row_id': removed[actor_id].pop(0), 'role': role, 'updated_at': now})
+        else:
+          inserted.append({'actor_id': actor_id, 'movie_id': movie_id, 'role': role, 'updated_at': now})
+      deleted = [id for ids in removed.values() for id in ids]
+
+      if deleted:
+        db.session.execute(table.delete().where(table.c.id.in_(deleted)))
+      if updated:
+        db.session.execute(table.update().where(table.c.id == bindparam('row_id')).values(
+          role=bindparam('role'), updated_at=bindparam('updated_at')), updated)
+      if inserted:
+        db.session.execute(table.insert().values(inserted))
+      if deleted or updated or inserted:
+        Movie.touch([movie_id])
+        TableVersion.bump('MovieRoles')
+      return {'inserted': len(inserted), 'updated': len(updated), 'deleted': len(deleted)}
 
     def format(self):
       return {
         'id': self.id,
         'actor_id': self.actor_id,
         'movie_id': self.movie_id,
-        'role': self.role}
\ No newline at end of file
+        'role': self.role}
+
+'''
+sqlite_search_ddl(table, columns)
+    SQLite stand-in for the Postgres trigram indexes: an FTS5 trigram index over
+    the searchable columns, kept in sync with the table by triggers
+'''
+def sqlite_search_ddl(table, columns):
+  index = table + 'Search'
+  names = ', '.join(columns)
+  new_values = ', '.join('new.' + column for column in columns)
+  old_values = ', '.join('old.' + column for column in columns)
+
+  return [
+    f'''CREATE VIRTUAL TABLE "{index}" USING fts5({names}, content='{table}', content_rowid='id', tokenize='trigram')''',
+    f'''CREATE TRIGGER "{table}_search_insert" AFTER INSERT ON "{table}" BEGIN
+      INSERT INTO "{index}"(rowid, {names}) VALUES (new.id, {new_values});
+    END''',
+    f'''CREATE TRIGGER "{table}_search_delete" AFTER DELETE ON "{table}" BEGIN
+      INSERT INTO "{index}"("{index}", rowid, {names}) VALUES ('delete', old.id, {old_values});
+    END''',
+    f'''CREATE TRIGGER "{table}_search_update" AFTER UPDATE ON "{table}" BEGIN
+      INSERT INTO "{index}"("{index}", rowid, {names}) VALUES ('delete', old.id, {old_values});
+      INSERT INTO "{index}"(rowid, {names}) VALUES (new.id, {new_values});
+    END'''
+  ]
+
+for model, columns in ((Movie, ('title', 'description')), (Actor, ('name', 'about'))):
+  for statement in sqlite_search_ddl(model.__tablename__, columns):
+    event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
@@ -0,0 +1,123 @@
+import re
+import logging
+from collections import Counter
+from functools import wraps
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Query budgets and N+1 detection
+
+With QUERY_TRACKING set to 'log' or 'raise' (for tests and staging), every
+SQL statement a request runs is recorded. A request fails the check when it
+runs more statements than its route's query_budget, or runs statements of
+the same shape N_PLUS_ONE_THRESHOLD times or more, which is the signature of
+a query inside a loop. 'log' logs a warning and 'raise' raises
+QueryBudgetExceeded. Tracking is off by default.
+'''
+
+N_PLUS_ONE_THRESHOLD = 5
+
+logger = logging.getLogger(__name__)
+
+# bound parameters, and lists of them as IN renders them, do not change a statement's shape
+PARAMETER_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s)(?:\s*,\s*(?:\?|%\(\w+\)s))*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def statement_shape(statement):
+    return PARAMETER_LIST.sub('(?)', WHITESPACE.sub(' ', statement).strip())
+
+'''
+QueryTracker
+    records the statements run while it is open. used per request by the
+    app, and directly by tests:
+
+        with QueryTracker() as queries:
+            client.get('/movies')
+        assert queries.count <= 3
+'''
+class QueryTracker:
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(Engine, 'after_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, 'after_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        return repeated_shapes(self.statements, threshold)
+
+def repeated_shapes(statements, threshold=N_PLUS_ONE_THRESHOLD):
+    shapes = Counter(statement_shape(statement) for statement in statements)
+    return {shape: count for shape, count in shapes.items() if count >= threshold}
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'tracked_statements' in g:
+        g.tracked_statements.append(statement)
+
+'''
+query_budget(count, allow_repeats)
+    the most SQL statements the route may run in one request, None for no
+    limit. routes that work through their input in batches, and so repeat
+    statements by design, pass allow_repeats=True
+'''
+def query_budget(count=None, allow_repeats=False):
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.query_budget = count
+            g.allow_repeated_queries = allow_repeats
+            return f(*args, **kwargs)
+        wrapper.query_budget = count
+        wrapper.allow_repeated_queries = allow_repeats
+        return wrapper
+    return query_budget_decorator
+
+def problems(statements, budget, allow_repeats=False):
+    found = []
+    if budget is not None and len(statements) > budget:
+        found.append('ran {} queries, over its budget of {}'.format(len(statements), budget))
+
+    if not allow_repeats:
+        for shape, count in repeated_shapes(statements).items():
+            found.append('ran the same query {} times, a likely N+1: {}'.format(count, shape))
+    return found
+
+'''
+init_query_tracking(app)
+    checks every request of the app against its query budget when
+    QUERY_TRACKING is 'log' or 'raise'
+'''
+def init_query_tracking(app):
+    mode = app.config.get('QUERY_TRACKING', 'off')
+    if mode not in ('log', 'raise'):
+        return
+
+    @app.before_request
+    def start_tracking():
+        g.tracked_statements = []
+
+    @app.after_request
+    def check_queries(response):
+        found = problems(g.get('tracked_statements', []), g.get('query_budget'), g.get('allow_repeated_queries', False))
+        if found:
+            message = '{} {} {}'.format(request.method, request.path, '; '.join(found))
+            if mode == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,91 @@
+import datetime
+import json
+from flask import current_app
+from werkzeug.http import http_date
+from sqlalchemy import Integer, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from models import db
+from metrics import timed
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+'''
+Read models for the list and search endpoints
+
+Pages are read as plain row tuples of the columns format() returns, executed
+with Core, so no ORM instances are built or tracked in the identity map. Rows
+go straight to JSON with orjson when it is installed. release_date keeps the
+HTTP date format Flask's encoder gives it everywhere else in the API.
+'''
+
+def encode_value(value):
+  if isinstance(value, (datetime.datetime, datetime.date)):
+    return http_date(value)
+  return value
+
+'''
+parse_fields(model, value)
+    turns a comma separated ?fields= value into the model columns to read, in
+    format() order. id is always included. raises ValueError on unknown fields
+'''
+def parse_fields(model, value):
+  if not value:
+    return model.FIELDS
+
+  fields = {field.strip() for field in value.split(',') if field.strip()}
+  unknown = fields - set(model.FIELDS)
+  if unknown:
+    raise ValueError('unknown fields: ' + ', '.join(sorted(unknown)))
+  return tuple(field for field in model.FIELDS if field == 'id' or field in fields)
+
+'''
+read_rows(selection, fields)
+    runs the model query with only the given format() columns selected (all of
+    them by default) and returns the rows as the dicts format() would produce
+'''
+def read_rows(selection, fields=None):
+  model = selection.column_descriptions[0]['entity']
+  names = fields or model.FIELDS
+  columns = [model.__table__.c[name] for name in names]
+
+  result = db.session.execute(selection.with_entities(*columns).statement)
+  return [
+    {name: encode_value(value) for name, value in zip(names, row)}
+    for row in result
+  ]
+
+'''
+id_filter(model, ids)
+    matches the rows with the given ids: id = ANY(:ids) with one array parameter
+    on Postgres, so the statement is the same for any number of ids, and IN
+    elsewhere
+'''
+def id_filter(model, ids):
+  if db.session.get_bind().dialect.name == 'postgresql':
+    return model.id == any_(bindparam('ids', ids, type_=ARRAY(Integer)))
+  return model.id.in_(ids)
+
+'''
+read_rows_by_id(model, ids, fields)
+    reads the rows with the given ids in one query and returns them in the
+    order of ids, along with the ids that matched no row
+'''
+def read_rows_by_id(model, ids, fields=None):
+  rows = {row['id']: row for row in read_rows(model.query.filter(id_filter(model, ids)), fields)}
+  return [rows[id] for id in ids if id in rows], [id for id in ids if id not in rows]
+
+'''
+json_response(data)
+    serializes data with the fast encoder and wraps it in a JSON response
+'''
+def json_response(data, status=200):
+  with timed('serialize'):
+    if orjson is not None:
+      body = orjson.dumps(data)
+    else:
+      body = json.dumps(data, separators=(',', ':'), default=encode_value)
+
+  return current_app.response_class(body, status=status, mimetype='application/json')
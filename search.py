@@ -0,0 +1,77 @@
+from sqlalchemy import func, or_, text, column, Integer, Float
+from models import db, Movie, Actor
+
+'''
+Full-text search over movies and actors
+
+On Postgres the searchable columns carry pg_trgm GIN indexes, so the ILIKE
+filter is answered from the index and results are ranked by word_similarity.
+On SQLite the same columns are mirrored into an FTS5 trigram table and ranked
+with bm25. Terms shorter than a trigram fall back to a plain ILIKE filter.
+'''
+
+SEARCH_COLUMNS = {
+  Movie: ('title', 'description'),
+  Actor: ('name', 'about')
+}
+
+# the first column (title/name) counts for more than the long text columns
+COLUMN_WEIGHTS = (1.0, 0.5)
+
+MIN_TRIGRAM_TERM_LENGTH = 3
+
+def escape_like(term):
+  return term.replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+def like_filter(model, term):
+  pattern = '%{}%'.format(escape_like(term))
+  columns = [getattr(model, name) for name in SEARCH_COLUMNS[model]]
+  return or_(*[column.ilike(pattern, escape='/') for column in columns])
+
+def search_postgresql(model, term):
+  match = like_filter(model, term)
+  columns = [getattr(model, name) for name in SEARCH_COLUMNS[model]]
+  rank = func.greatest(*[
+    func.word_similarity(term, func.coalesce(column, '')) * weight
+    for column, weight in zip(columns, COLUMN_WEIGHTS)])
+
+  selection = model.query.filter(match)
+  total = db.session.query(func.count(model.id)).filter(match)
+  return selection, [rank.desc(), model.id], total
+
+def search_sqlite(model, term):
+  index = model.__tablename__ + 'Search'
+  weights = ', '.join(str(weight) for weight in COLUMN_WEIGHTS)
+  query = '"{}"'.format(term.replace('"', '""'))
+
+  matches = text(
+    f'SELECT rowid AS id, bm25("{index}", {weights}) AS rank '
+    f'FROM "{index}" WHERE "{index}" MATCH :query'
+  ).bindparams(query=query).columns(column('id', Integer), column('rank', Float)).alias('matches')
+
+  selection = model.query.join(matches, matches.c.id == model.id)
+  total = db.session.query(func.count()).select_from(matches)
+  return selection, [matches.c.rank, model.id], total
+
+def search_like(model, term):
+  match = like_filter(model, term)
+  selection = model.query.filter(match)
+  total = db.session.query(func.count(model.id)).filter(match)
+  return selection, [model.id], total
+
+'''
+search_items(model, term)
+    returns the unordered query of rows matching term, the ordering that ranks
+    them and the query counting the matches, which is left to the caller to run
+'''
+def search_items(model, term):
+  term = (term or '').strip()
+  dialect = db.session.get_bind().dialect.name
+
+  if len(term) < MIN_TRIGRAM_TERM_LENGTH:
+    return search_like(model, term)
+  if dialect == 'postgresql':
+    return search_postgresql(model, term)
+  if dialect == 'sqlite':
+    return search_sqlite(model, term)
+  return search_like(model, term)
@@ -1,15 +1,55 @@
 import os
 import unittest
 import json
+import time
+import datetime
+import gzip
+import base64
+import threading
+import tempfile
+import random
+import collections
+from unittest import mock
+from flask import g
+from jose import jwt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError, IntegrityError
 
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import setup_db, db, apply_statement_timeout, unit_of_work, Movie, Actor, MovieRoles, TableCount, TableVersion, PoolStats, ReplicaSet, engine_options
+from counts import table_total, query_total
+from search import search_items
+from auth.auth import JWKSCache, TokenCache, verify_decode_jwt, AUTH0_DOMAIN, API_AUDIENCE
+from cache import LocalCache, SharedCache
+from read_models import read_rows
+from generate import role_rows
+from bulk import update_many, update_from_values
+from metrics import Histogram
+from query_tracker import QueryTracker, query_budget, statement_shape, problems
+from benchmarks.load_test import start_jwks_server, KEYS_DIR, KID, PERMISSIONS
 
 DIRECTOR_TOKEN = os.environ['DIRECTOR']
 ASSISTANT_TOKEN = os.environ['ASSISTANT']
 PRODUCER_TOKEN = os.environ['PRODUCER']
 
+class InMemoryClient:
+    """Local stand-in for the shared cache's redis client"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+class QueryCanceled(Exception):
+    """Stand-in for the psycopg2 error of a cancelled statement"""
+    pgcode = '57014'
+
 class CastingAgencyTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
@@ -345,6 +385,1008 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['actors']))
 
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.jwks = json.dumps({'keys': [{'kid': 'key1', 'kty': 'RSA', 'use': 'sig', 'n': 'n', 'e': 'AQAB'}]}).encode()
+        self.cache = JWKSCache('https://example.com/.well-known/jwks.json', ttl=600, min_refetch_interval=600)
+
+    def test_steady_state_serves_keys_from_memory(self):
+        with mock.patch('auth.auth.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = self.jwks
+            for _ in range(10):
+                self.assertEqual(self.cache.get_key('key1')['kid'], 'key1')
+
+        self.assertEqual(self.cache.stats()['fetches'], 1)
+        self.assertEqual(self.cache.stats()['hits'], 10)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        with mock.patch('auth.auth.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = self.jwks
+            self.cache.get_key('key1')
+            for _ in range(10):
+                self.assertIsNone(self.cache.get_key('key2'))
+
+        self.assertEqual(self.cache.stats()['fetches'], 1)
+
+    def test_failed_fetch_keeps_last_good_keys(self):
+        with mock.patch('auth.auth.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = self.jwks
+            self.cache.get_key('key1')
+            urlopen.side_effect = OSError('unavailable')
+            self.assertFalse(self.cache.fetch())
+
+        self.assertEqual(self.cache.get_key('key1')['kid'], 'key1')
+        self.assertEqual(self.cache.stats()['failures'], 1)
+
+    def test_failing_first_fetch_is_rate_limited(self):
+        with mock.patch('auth.auth.urlopen', side_effect=OSError('unavailable')) as urlopen:
+            for _ in range(10):
+                self.assertIsNone(self.cache.get_key('key1'))
+
+        self.assertEqual(urlopen.call_count, 1)
+        self.assertEqual(urlopen.call_args[1]['timeout'], self.cache.timeout)
+
+    def test_concurrent_first_requests_wait_for_one_fetch(self):
+        def slow_urlopen(url, timeout):
+            time.sleep(0.1)
+            return mock.Mock(read=mock.Mock(return_value=self.jwks))
+
+        keys = []
+        with mock.patch('auth.auth.urlopen', side_effect=slow_urlopen):
+            threads = [threading.Thread(target=lambda: keys.append(self.cache.get_key('key1'))) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([key['kid'] for key in keys], ['key1'] * 8)
+        self.assertEqual(self.cache.stats()['fetches'], 1)
+
+    def test_failed_background_refresh_backs_off(self):
+        with mock.patch('auth.auth.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = self.jwks
+            self.cache.get_key('key1')
+            self.cache.fetched_at -= 601
+            self.cache.last_attempt_at -= 601
+            urlopen.side_effect = OSError('unavailable')
+            with mock.patch('auth.auth.threading.Thread') as thread:
+                for _ in range(10):
+                    self.assertEqual(self.cache.get_key('key1')['kid'], 'key1')
+                    self.cache.refreshing = False
+
+        self.assertEqual(thread.call_count, 1)
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.jwks = JWKSCache('https://example.com/.well-known/jwks.json')
+        self.jwks.keys = {'key1': {'kid': 'key1'}}
+        self.cache = TokenCache(self.jwks, max_size=2)
+        self.payload = {'exp': time.time() + 60, 'permissions': ['get:movies']}
+
+    def test_repeated_token_is_served_from_cache(self):
+        self.cache.set('token', 'key1', self.payload)
+
+        self.assertEqual(self.cache.get('token'), self.payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_expired_token_is_never_served(self):
+        self.cache.set('token', 'key1', {'exp': time.time() - 1})
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_token_dropped_when_kid_leaves_jwks(self):
+        self.cache.set('token', 'key1', self.payload)
+        self.jwks.keys = {'key2': {'kid': 'key2'}}
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_cache_hit_refreshes_stale_keys(self):
+        self.cache.set('token', 'key1', self.payload)
+        self.jwks.fetched_at = time.monotonic() - self.jwks.ttl - 1
+        with mock.patch('auth.auth.jwks_cache', self.jwks), mock.patch('auth.auth.token_cache', self.cache):
+            with mock.patch('auth.auth.threading.Thread') as thread:
+                self.assertEqual(verify_decode_jwt('token'), self.payload)
+
+        self.assertEqual(thread.call_count, 1)
+
+    def test_least_recently_used_token_is_evicted(self):
+        self.cache.set('token1', 'key1', self.payload)
+        self.cache.set('token2', 'key1', self.payload)
+        self.cache.get('token1')
+        self.cache.set('token3', 'key1', self.payload)
+
+        self.assertIsNone(self.cache.get('token2'))
+        self.assertEqual(self.cache.get('token1'), self.payload)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+class LocalCacheTestCase(unittest.TestCase):
+    """This class represents the in-process response cache test case"""
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LocalCache(max_size=2, ttl=60)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.get('a')
+        cache.set('c', b'3')
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+
+    def test_expired_entry_is_not_served(self):
+        cache = LocalCache(max_size=2, ttl=0)
+        cache.set('a', b'1')
+
+        self.assertIsNone(cache.get('a'))
+
+class DatabaseSettingsTestCase(unittest.TestCase):
+    """This class represents the connection pool settings test case"""
+
+    def test_postgres_gets_bounded_pool_and_timeouts(self):
+        options = engine_options({'DB_POOL_SIZE': '3', 'DB_STATEMENT_TIMEOUT': 1500}, 'postgresql://localhost/agency')
+
+        self.assertEqual(options['pool_size'], 3)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIn('statement_timeout=1500', options['connect_args']['options'])
+
+    def test_sqlite_gets_no_pool_size(self):
+        options = engine_options({}, 'sqlite:///agency.db')
+
+        self.assertNotIn('pool_size', options)
+
+    def test_pool_stats_count_waits_and_timeouts(self):
+        stats = PoolStats()
+        stats.record(0.5)
+        stats.record(1.5, timed_out=True)
+
+        self.assertEqual(stats.stats()['checkouts'], 1)
+        self.assertEqual(stats.stats()['timeouts'], 1)
+        self.assertEqual(stats.stats()['mean_wait_seconds'], 1.0)
+
+    def test_bulk_loads_lift_the_timeouts(self):
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+        with create_app().app_context():
+            g.statement_timeout = 0
+            g.lock_timeout = 0
+            apply_statement_timeout(None, None, connection)
+
+        connection.execute.assert_has_calls([
+            mock.call('SET LOCAL statement_timeout = 0'),
+            mock.call('SET LOCAL lock_timeout = 0')])
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica_path = 'sqlite:///{}/replica.db'.format(self.directory.name)
+        self.app = create_app({'DATABASE_REPLICA_URLS': self.replica_path})
+        self.replica = self.app.extensions['read_replicas'].engines[0]
+
+    def tearDown(self):
+        self.replica.dispose()
+        self.directory.cleanup()
+
+    def test_get_request_reads_from_replica(self):
+        with self.app.test_request_context('/movies', method='GET'):
+            self.assertIs(db.session.get_bind(), self.replica)
+            db.session.remove()
+
+    def test_write_request_uses_primary(self):
+        with self.app.test_request_context('/movies', method='POST'):
+            self.assertIsNot(db.session.get_bind(), self.replica)
+            db.session.remove()
+
+    def test_reads_after_a_write_stay_on_primary(self):
+        with self.app.test_request_context('/movies', method='GET'):
+            db.session.execute(Movie.__table__.update().where(Movie.id == 0).values(title='x'))
+            self.assertIsNot(db.session.get_bind(), self.replica)
+            db.session.rollback()
+            db.session.remove()
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        replicas = ReplicaSet([create_engine('sqlite:////nonexistent/replica.db')])
+
+        self.assertIsNone(replicas.choose())
+        self.assertFalse(replicas.stats()[0]['healthy'])
+
+class SQLiteTestCase(unittest.TestCase):
+    """Base for test cases run against a throwaway SQLite database, inside an app context"""
+
+    config = None
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = self.create_app(self.config)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def create_app(self, config=None):
+        app = create_app(config)
+        setup_db(app, 'sqlite:///{}/agency.db'.format(self.directory.name))
+        return app
+
+class EndpointTestCase(SQLiteTestCase):
+    """This class represents the API endpoint test case, with tokens signed by the
+    benchmark key and verified against it through a local JWKS server"""
+
+    config = {'QUERY_TRACKING': 'raise'}
+
+    @classmethod
+    def setUpClass(cls):
+        jwks_server = start_jwks_server()
+        cls.addClassCleanup(jwks_server.shutdown)
+        jwks = JWKSCache('http://127.0.0.1:{}/.well-known/jwks.json'.format(jwks_server.server_port))
+        for name, value in (('jwks_cache', jwks), ('token_cache', TokenCache(jwks))):
+            patch = mock.patch('auth.auth.' + name, value)
+            patch.start()
+            cls.addClassCleanup(patch.stop)
+
+        with open(os.path.join(KEYS_DIR, 'benchmark_key.pem')) as f:
+            key = f.read()
+        now = int(time.time())
+        cls.token = jwt.encode({
+            'iss': 'https://{}/'.format(AUTH0_DOMAIN),
+            'sub': 'test',
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + 3600,
+            'permissions': PERMISSIONS
+        }, key, algorithm='RS256', headers={'kid': KID})
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+
+        with unit_of_work():
+            actor = Actor('Actor One', 30, 'female', '', 'A frog prince')
+            actor.insert()
+            movie = Movie('The Princess and the Frog', datetime.datetime(2009, 12, 11), '', 'A frog and a princess')
+            movie.insert()
+            MovieRoles.insert_many(movie.id, [{'actor_id': actor.id, 'role': 'Lead'}])
+
+        # SQLite takes no date strings, so the new movie has no release_date
+        self.new_movie = {
+            'title':'First Movie',
+            "image_url": "https://upload.wikimedia.org/wikipedia/en/thumb/8/81/The_Princess_and_the_Frog_poster.jpg/220px-The_Princess_and_the_Frog_poster.jpg",
+            "roles": []
+        }
+
+        self.new_actor = {
+            'name':'Actor One',
+            'age':30,
+            'gender':'female'
+        }
+
+        self.wrong_actor = {
+            'age':'30',
+            'gender':90
+        }
+
+    def test_304_sent_when_movies_not_modified(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies', headers=headers)
+        etag = res.headers['ETag']
+        res = self.client().get('/movies', headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_movies_etag_changes_after_write(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies', headers=headers)
+        etag = res.headers['ETag']
+        self.client().post('/movies', headers=headers, json=self.new_movie)
+        res = self.client().get('/movies', headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_table_versions_read_once_per_request(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        with QueryTracker() as queries:
+            res = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len([statement for statement in queries.statements if 'FROM "TableVersion"' in statement]), 1)
+
+    def test_movies_served_from_shared_cache_until_write(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        cache = SharedCache(InMemoryClient())
+        client = self.create_app({'RESPONSE_CACHE': cache}).test_client()
+
+        first = client.get('/movies', headers=headers)
+        second = client.get('/movies', headers=headers)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        client.post('/movies', headers=headers, json=self.new_movie)
+        client.get('/movies', headers=headers)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_read_rows_match_format(self):
+        with self.app.test_request_context():
+            rows = read_rows(Movie.query.order_by(Movie.id).limit(5))
+            movies = Movie.query.order_by(Movie.id).limit(5).all()
+            formatted = json.loads(self.app.json_encoder().encode([movie.format() for movie in movies]))
+
+            self.assertEqual(rows, formatted)
+
+    def test_get_movies_page_limited_to_page_size(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?page=1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['movies']) <= 10)
+
+    def test_404_sent_requesting_movies_invalid_page(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?page=0', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_by_cursor(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?cursor=&per_page=1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertIn('next_cursor', data)
+
+    def test_400_sent_requesting_movies_with_invalid_cursor(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?cursor=invalid', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_sent_requesting_movies_with_non_integer_cursor(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        for value in ([1], '1', 1.5):
+            cursor = base64.urlsafe_b64encode(json.dumps({'key': 'id', 'value': value}).encode()).decode()
+            res = self.client().get('/movies?cursor=' + cursor, headers=headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_400_sent_searching_movies_with_invalid_cursor(self):
+        res = self.client().post('/movies/search?cursor=invalid', json={'searchTerm': 'frog'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_sent_paging_search_by_cursor(self):
+        res = self.client().post('/actors/search?cursor=', json={'searchTerm': 'frog'})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_with_sparse_fields(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?fields=title,release_date', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['movies'][0]), {'id', 'title', 'release_date'})
+
+    def test_400_sent_requesting_unknown_fields(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?fields=title,budget', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_failed_create_movie_rolls_back_whole_request(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        self.new_movie['title'] = 'Rolled Back Movie'
+        self.new_movie['roles'] = [{'actor_id': 1}]
+        res = self.client().post('/movies', headers=headers, json=self.new_movie)
+
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.filter(Movie.title == 'Rolled Back Movie').count(), 0)
+
+    def test_get_movie_with_expanded_actors(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        self.new_movie['roles'] = [{'actor_id': 1, 'role': 'Lead'}]
+        res = self.client().post('/movies', headers=headers, json=self.new_movie)
+        movie_id = json.loads(res.data)['created']
+
+        res = self.client().get('/movies/{}?expand=actors'.format(movie_id), headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['roles'][0]['actor']['id'], 1)
+
+    def test_delete_movie_cascades_to_roles(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        self.new_movie['roles'] = [{'actor_id': 1, 'role': 'Lead'}]
+        res = self.client().post('/movies', headers=headers, json=self.new_movie)
+        movie_id = json.loads(res.data)['created']
+
+        res = self.client().delete('/movies/{}'.format(movie_id), headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(MovieRoles.query.filter(MovieRoles.movie_id == movie_id).count(), 0)
+
+    def test_search_movies_matches_description_with_total(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        self.new_movie['description'] = 'A swamp adventure'
+        self.client().post('/movies', headers=headers, json=self.new_movie)
+        res = self.client().post('/movies/search', json={'searchTerm': 'swamp'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['movies']))
+        self.assertTrue(data['total_movies'] >= len(data['movies']))
+
+    def test_search_movies_without_count(self):
+        res = self.client().post('/movies/search?count=none', json={'searchTerm': 'swamp'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('total_movies', data)
+
+    def test_retrieve_movies_with_total(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        self.client().post('/movies', headers=headers, json=self.new_movie)
+        res = self.client().get('/movies', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['total_movies'] >= len(data['movies']))
+        self.assertFalse(data['total_estimated'])
+
+    def test_get_movies_by_id_keeps_order(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        first = json.loads(self.client().post('/movies', headers=headers, json=self.new_movie).data)['created']
+        second = json.loads(self.client().post('/movies', headers=headers, json=self.new_movie).data)['created']
+        res = self.client().get('/movies?ids={},0,{}'.format(second, first), headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [second, first])
+        self.assertEqual(data['missing'], [0])
+
+    def test_lookup_actors_by_id(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        actor_id = json.loads(self.client().post('/actors', headers=headers, json=self.new_actor).data)['created']
+        res = self.client().post('/actors/lookup?fields=name', headers=headers, json={'ids': [actor_id]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'id': actor_id, 'name': self.new_actor['name']}])
+        self.assertEqual(data['missing'], [])
+
+    def test_400_if_ids_are_not_integers(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        for ids in ([1.9], [True], ['1'], [None]):
+            res = self.client().post('/movies/lookup', headers=headers, json={'ids': ids})
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_400_if_too_many_ids(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        with mock.patch('app.MAX_BATCH_GET_SIZE', 2):
+            res = self.client().post('/movies/lookup', headers=headers, json={'ids': [1, 2, 3]})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_batch_update_movies_reports_each_item(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        movie_id = json.loads(self.client().post('/movies', headers=headers, json=self.new_movie).data)['created']
+        res = self.client().patch('/movies', headers=headers, json=[
+            {'id': movie_id, 'changes': {'description': 'Edited'}},
+            {'id': 0, 'changes': {'description': 'Edited'}}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual([result['status'] for result in data['results']], ['updated', 'not_found'])
+
+    def test_422_if_atomic_batch_update_has_invalid_item(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        actor_id = json.loads(self.client().post('/actors', headers=headers, json=self.new_actor).data)['created']
+        res = self.client().patch('/actors?atomic=true', headers=headers, json=[
+            {'id': actor_id, 'changes': {'name': 'Renamed'}},
+            {'id': actor_id + 1, 'changes': {'age': -1}}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['updated'], 0)
+
+    def test_400_if_count_mode_unknown(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies?count=all', headers=headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_503_if_search_runs_over_its_time_budget(self):
+        canceled = OperationalError('SELECT', {}, QueryCanceled())
+        with mock.patch('app.search_items', side_effect=canceled):
+            res = self.client().post('/movies/search', json={'searchTerm': 'swamp'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertIn('Retry-After', res.headers)
+
+    def test_health_reports_pool_checkout_waits(self):
+        res = self.client().get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('mean_wait_seconds', data['pool'])
+
+    def test_create_movie_with_minimal_return(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token,
+        'Prefer': 'return=minimal'}
+
+        res = self.client().post('/movies', headers=headers, json=self.new_movie)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Preference-Applied'], 'return=minimal')
+        self.assertEqual(set(data), {'success', 'created', 'version'})
+
+    def test_delete_actor_with_representation_return(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        actor_id = json.loads(self.client().post('/actors', headers=headers, json=self.new_actor).data)['created']
+        headers['Prefer'] = 'return=representation'
+        res = self.client().delete('/actors/{}'.format(actor_id), headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], actor_id)
+        self.assertEqual(data['actor']['name'], self.new_actor['name'])
+        self.assertNotIn('actors', data)
+
+    def test_every_endpoint_stays_within_its_query_budget(self):
+        headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + self.token}
+
+        actor_id = json.loads(self.client().post('/actors', headers=headers, json=self.new_actor).data)['created']
+        self.new_movie['roles'] = [{'actor_id': actor_id, 'role': 'Lead'}]
+        movie_id = json.loads(self.client().post('/movies', headers=headers, json=self.new_movie).data)['created']
+
+        requests = {
+            'retrieve_movies': ('get', '/movies', {}),
+            'get_movie': ('get', '/movies/{}?expand=actors'.format(movie_id), {}),
+            'search_movie': ('post', '/movies/search', {'json': {'searchTerm': 'First'}}),
+            'lookup_movies': ('post', '/movies/lookup', {'json': {'ids': [movie_id, 0]}}),
+            'export_movies': ('get', '/movies/export?expand=roles', {}),
+            'create_movie': ('post', '/movies', {'json': self.new_movie}),
+            'bulk_import_movies': ('post', '/movies/bulk', {'data': json.dumps(self.new_movie)}),
+            'update_movie': ('patch', '/movies/{}'.format(movie_id), {'json': {'title': 'Renamed', 'roles': self.new_movie['roles']}}),
+            'retrieve_actors': ('get', '/actors', {}),
+            'get_actor': ('get', '/actors/{}?expand=movies'.format(actor_id), {}),
+            'search_actor': ('post', '/actors/search', {'json': {'searchTerm': 'Actor'}}),
+            'lookup_actors': ('post', '/actors/lookup', {'json': {'ids': [actor_id]}}),
+            'export_actors': ('get', '/actors/export', {}),
+            'create_actor': ('post', '/actors', {'json': self.new_actor}),
+            'bulk_import_actors': ('post', '/actors/bulk', {'data': json.dumps(self.new_actor)}),
+            'update_actor': ('patch', '/actors/{}'.format(actor_id), {'json': {'name': 'Renamed'}}),
+            'batch_update_movies': ('patch', '/movies', {'json': [{'id': movie_id, 'changes': {'description': 'Edited'}}]}),
+            'batch_update_actors': ('patch', '/actors?atomic=true', {'json': [{'id': actor_id, 'changes': {'about': 'Edited', 'age': 31}}]}),
+            'delete_movie': ('delete', '/movies/{}'.format(movie_id), {}),
+            'delete_actor': ('delete', '/actors/{}'.format(actor_id), {}),
+            'health': ('get', '/health', {}),
+            'metrics': ('get', '/metrics', {})
+        }
+        self.assertEqual(set(requests), set(self.app.view_functions) - {'static'})
+
+        for endpoint, (method, path, kwargs) in requests.items():
+            with self.subTest(endpoint=endpoint):
+                with QueryTracker() as queries:
+                    res = getattr(self.client(), method)(path, headers=headers, **kwargs)
+                    res.get_data()
+
+                view = self.app.view_functions[endpoint]
+                self.assertEqual(res.status_code, 200)
+                if view.query_budget is not None:
+                    self.assertLessEqual(queries.count, view.query_budget)
+                if not view.allow_repeated_queries:
+                    self.assertEqual(queries.repeated(), {})
+
+    def test_bulk_import_actors_reports_invalid_lines(self):
+        headers = {
+        'Content-Type': 'application/x-ndjson',
+        'Authorization': 'Bearer ' + self.token}
+
+        lines = [json.dumps(self.new_actor), '{not json', json.dumps(self.wrong_actor)]
+        res = self.client().post('/actors/bulk', headers=headers, data='\n'.join(lines))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 3])
+
+    def test_bulk_import_movies_with_roles(self):
+        headers = {
+        'Content-Type': 'application/x-ndjson',
+        'Authorization': 'Bearer ' + self.token}
+
+        self.new_movie['roles'] = [{'actor_id': 1, 'role': 'Lead'}]
+        res = self.client().post('/movies/bulk?chunk_size=1', headers=headers, data='\n'.join([json.dumps(self.new_movie)] * 3))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['failed'], 0)
+
+    def test_export_movies_as_ndjson(self):
+        headers = {
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/movies/export?expand=roles', headers=headers)
+        lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(len(lines))
+        self.assertIn('roles', lines[0])
+
+    def test_export_actors_gzipped_when_accepted(self):
+        headers = {
+        'Accept-Encoding': 'gzip',
+        'Authorization': 'Bearer ' + self.token}
+
+        res = self.client().get('/actors/export', headers=headers)
+        lines = gzip.decompress(res.data).decode().splitlines()
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(json.loads(lines[0])['name'], 'Actor One')
+
+class TableVersionTestCase(SQLiteTestCase):
+    """This class represents the table version test case"""
+
+    def versions(self):
+        return {version.name: version.version for version in TableVersion.query}
+
+    def test_tables_are_bumped_once_at_commit(self):
+        before = self.versions()
+        with QueryTracker() as queries:
+            with unit_of_work():
+                Movie('The Frog', None, '', '').insert()
+                MovieRoles.insert_many(Movie.query.one().id, [])
+                TableVersion.bump('MovieRoles', 'Movie')
+
+        bumps = [statement for statement in queries.statements if statement.startswith('UPDATE "TableVersion"')]
+        self.assertEqual(len(bumps), 1)
+        self.assertEqual(self.versions()['Movie'], before['Movie'] + 1)
+        self.assertEqual(self.versions()['MovieRoles'], before['MovieRoles'] + 1)
+
+    def test_rolled_back_bumps_are_dropped(self):
+        before = self.versions()
+        try:
+            with unit_of_work():
+                TableVersion.bump('Actor')
+                raise ValueError
+        except ValueError:
+            pass
+
+        with unit_of_work():
+            pass
+        self.assertEqual(self.versions(), before)
+
+class TableCountTestCase(SQLiteTestCase):
+    """This class represents the row counter test case"""
+
+    def assertCounted(self, model):
+        self.assertEqual(TableCount.get(model.__tablename__), model.query.count())
+
+    def test_inserts_and_deletes_keep_the_count(self):
+        with unit_of_work():
+            for n in range(3):
+                Actor('Actor {}'.format(n), 30, 'female', '', '').insert()
+        self.assertCounted(Actor)
+
+        with unit_of_work():
+            Actor.query.first().delete()
+            Actor.delete_by_id(Actor.query.first().id)
+            Actor.delete_by_id(0)
+        self.assertCounted(Actor)
+        self.assertEqual(table_total(Actor), (1, False))
+
+    def test_rolled_back_insert_is_not_counted(self):
+        try:
+            with unit_of_work():
+                Movie('Lost', None, '', '').insert()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertCounted(Movie)
+
+    def test_estimate_falls_back_to_exact_count(self):
+        with unit_of_work():
+            Movie('The Frog', None, '', '').insert()
+        selection, ranking, count_query = search_items(Movie, 'frog')
+
+        self.assertEqual(table_total(Movie, 'estimate'), (1, False))
+        self.assertEqual(query_total(selection, count_query, 'estimate'), (1, False))
+        self.assertEqual(query_total(selection, count_query, 'none'), (None, False))
+
+class BatchUpdateTestCase(SQLiteTestCase):
+    """This class represents the batch update test case"""
+
+    def setUp(self):
+        super().setUp()
+        with unit_of_work():
+            for n in range(3):
+                Actor('Actor {}'.format(n), 30, 'female', '', '').insert()
+        self.ids = [id for (id,) in db.session.query(Actor.id).order_by(Actor.id)]
+
+    def test_updates_are_grouped_and_applied(self):
+        report = update_many(Actor, [
+            {'id': self.ids[0], 'changes': {'age': 40}},
+            {'id': self.ids[1], 'changes': {'age': 41, 'about': 'Edited'}},
+            {'id': self.ids[2], 'changes': {'age': 42}}])
+
+        self.assertEqual(report.format()['updated'], 3)
+        self.assertEqual([actor.age for actor in Actor.query.order_by(Actor.id)], [40, 41, 42])
+        self.assertEqual(Actor.query.get(self.ids[1]).about, 'Edited')
+
+    def test_postgres_updates_join_a_values_list(self):
+        session = mock.Mock()
+        with mock.patch('bulk.db.session', session):
+            update_from_values(Actor.__table__, ('age',), [{'row_id': 1, 'age': 40}, {'row_id': 2, 'age': 41}], postgresql.dialect())
+
+        statement, params = session.execute.call_args[0]
+        self.assertEqual(session.execute.call_count, 1)
+        self.assertIn('FROM (VALUES (:row_id_0, :age_0), (:row_id_1, :age_1)) AS v', str(statement))
+        self.assertIn('"age" = CAST(v."age" AS INTEGER)', str(statement))
+        self.assertEqual((params['row_id_1'], params['age_1']), (2, 41))
+
+    def test_atomic_batch_writes_nothing_on_failure(self):
+        report = update_many(Actor, [
+            {'id': self.ids[0], 'changes': {'age': 40}},
+            {'id': self.ids[1], 'changes': {'gender': None}}], atomic=True)
+
+        self.assertEqual(report.failed, 2)
+        self.assertEqual(report.results[0]['status'], 'skipped')
+        self.assertEqual(Actor.query.get(self.ids[0]).age, 30)
+
+class RoleReconcileTestCase(SQLiteTestCase):
+    """This class represents the role reconciliation test case"""
+
+    def setUp(self):
+        super().setUp()
+        with unit_of_work():
+            for n in range(3):
+                Actor('Actor {}'.format(n), 30, 'female', '', '').insert()
+            Movie('The Frog', None, '', '').insert()
+        self.actors = [id for (id,) in db.session.query(Actor.id).order_by(Actor.id)]
+        self.movie_id = Movie.query.one().id
+        with unit_of_work():
+            MovieRoles.insert_many(self.movie_id, [
+                {'actor_id': self.actors[0], 'role': 'Frog'},
+                {'actor_id': self.actors[1], 'role': 'Princess'}])
+
+    def cast(self):
+        return {(role.actor_id, role.role): role.id for role in MovieRoles.query.filter(MovieRoles.movie_id == self.movie_id)}
+
+    def test_renamed_role_keeps_its_row(self):
+        before = self.cast()
+        with unit_of_work():
+            changes = MovieRoles.reconcile(self.movie_id, [
+                {'actor_id': self.actors[0], 'role': 'Frog'},
+                {'actor_id': self.actors[1], 'role': 'Queen'}])
+        after = self.cast()
+
+        self.assertEqual(changes, {'inserted': 0, 'updated': 1, 'deleted': 0})
+        self.assertEqual(after[(self.actors[1], 'Queen')], before[(self.actors[1], 'Princess')])
+        self.assertEqual(after[(self.actors[0], 'Frog')], before[(self.actors[0], 'Frog')])
+
+    def test_unchanged_cast_writes_nothing(self):
+        with QueryTracker() as queries:
+            with unit_of_work():
+                changes = MovieRoles.reconcile(self.movie_id, [
+                    {'actor_id': self.actors[1], 'role': 'Princess'},
+                    {'actor_id': self.actors[0], 'role': 'Frog'}])
+
+        self.assertEqual(changes, {'inserted': 0, 'updated': 0, 'deleted': 0})
+        self.assertEqual(queries.count, 1)
+
+    def test_added_and_removed_roles(self):
+        with unit_of_work():
+            changes = MovieRoles.reconcile(self.movie_id, [
+                {'actor_id': self.actors[2], 'role': 'King'},
+                {'actor_id': self.actors[2], 'role': 'King'}])
+
+        self.assertEqual(changes, {'inserted': 1, 'updated': 0, 'deleted': 2})
+        self.assertEqual(set(self.cast()), {(self.actors[2], 'King')})
+
+    def test_actor_is_cast_once_without_a_role(self):
+        row = {'actor_id': self.actors[2], 'movie_id': self.movie_id, 'role': None, 'updated_at': datetime.datetime.utcnow()}
+        with self.assertRaises(IntegrityError):
+            with unit_of_work():
+                db.session.execute(MovieRoles.__table__.insert(), [row, row])
+
+class CatalogueGeneratorTestCase(unittest.TestCase):
+    """This class represents the synthetic catalogue generator test case"""
+
+    def roles(self, seed, actor_skew=1.0):
+        return list(role_rows(random.Random(seed), range(1, 501), range(1, 101), 8, 1.0, 200, actor_skew, None))
+
+    def test_same_seed_generates_same_roles(self):
+        self.assertEqual(self.roles(7), self.roles(7))
+        self.assertNotEqual(self.roles(7), self.roles(8))
+
+    def test_popular_actors_are_cast_most(self):
+        appearances = collections.Counter(role['actor_id'] for role in self.roles(7))
+
+        self.assertEqual(appearances.most_common(1)[0][0], 1)
+        self.assertGreater(appearances[1], 10 * appearances[100])
+
+class MetricsTestCase(unittest.TestCase):
+    """This class represents the request timing and metrics test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+
+    def test_response_has_server_timing(self):
+        res = self.client().get('/health')
+
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertIn('desc="1 queries"', res.headers['Server-Timing'])
+
+    def test_metrics_publish_route_histograms(self):
+        self.client().get('/health')
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/health"}', res.data.decode())
+        self.assertIn('db_pool_checkout_wait_seconds', res.data.decode())
+
+    def test_failed_statement_leaves_nothing_on_the_connection(self):
+        with self.app.app_context():
+            with db.engine.connect() as connection:
+                with self.assertRaises(OperationalError):
+                    connection.execute('SELECT * FROM "NoSuchTable"')
+                connection.execute('SELECT 1')
+
+                self.assertNotIn('statement_started', connection.info)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'test', (1, 10))
+        histogram.observe((('route', '/'),), 0.5)
+        histogram.observe((('route', '/'),), 5)
+        lines = histogram.render()
+
+        self.assertIn('test_seconds_bucket{route="/",le="1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/",le="10"} 2', lines)
+        self.assertIn('test_seconds_count{route="/"} 2', lines)
+
+class QueryTrackerTestCase(unittest.TestCase):
+    """This class represents the query budget and N+1 detector test case"""
+
+    def test_in_lists_of_any_length_have_one_shape(self):
+        self.assertEqual(
+            statement_shape('SELECT * FROM "Movie" WHERE id IN (%(id_1)s, %(id_2)s)'),
+            statement_shape('SELECT * FROM "Movie"\n WHERE id IN (%(id_1)s)'))
+
+    def test_repeated_statement_is_reported_as_n_plus_one(self):
+        statements = ['SELECT * FROM "MovieRoles" WHERE movie_id = ?'] * 5
+
+        self.assertEqual(len(problems(statements, None)), 1)
+        self.assertEqual(problems(statements, None, allow_repeats=True), [])
+
+    def test_request_over_budget_fails_in_raise_mode(self):
+        app = create_app({'QUERY_TRACKING': 'raise'})
+
+        @app.route('/two-queries')
+        @query_budget(1)
+        def two_queries():
+            db.session.execute('SELECT 1')
+            db.session.execute('SELECT 2')
+            return 'ok'
+
+        res = app.test_client().get('/two-queries')
+
+        self.assertEqual(res.status_code, 500)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file